@@ -0,0 +1,172 @@
+# -*- coding: UTF-8
+
+import asyncio
+import functools
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DIRECTORY = '~/.pwstore/storage'
+
+
+class AsyncStore(object):
+    """ Entries of a storage directory for asyncio services
+
+    Searching the keys and reading or writing the files runs in the
+    default executor, searches one at a time as they share the key
+    indexes. gpg runs as asyncio subprocesses, at most concurrency at a
+    time per gpg binary, so one event loop serves many lookups at once.
+    Nothing process wide is changed: every store loads its own backends
+    and gpg gets its environment passed.
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, concurrency=None,
+                 gnupg_home=None):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.concurrency = concurrency
+        self.gnupg_home = gnupg_home
+        self._backends = None
+        self._gpg = {}
+        self._lock = None
+        self.log = logging.getLogger('asyncstore.AsyncStore')
+
+    # Helpers ################################################################
+
+    @property
+    def lock(self):
+        # Created on first use, inside the event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None,
+                                          functools.partial(function, *args))
+
+    async def _search(self, function, *args):
+        """ Runs function in the executor, after earlier searches """
+        async with self.lock:
+            return await self._run(function, *args)
+
+    def _load(self):
+        """ Returns the backends, caught up with changes of other processes
+
+        Like the daemon the manifest is checked and the indexes updated
+        before every search, so keys written elsewhere are found.
+        """
+        from backends import load_backends
+        from cache import BackendManifest
+
+        if self._backends is None or \
+                BackendManifest(self.directory).load() is None:
+            self._backends = load_backends(self.directory)
+            for backend in self._backends.values():
+                backend.use_ngrams = True
+        for backend in self._backends.values():
+            backend.index.update()
+        return self._backends
+
+    def gpg_for(self, backend):
+        """ Returns the AsyncGPG running the gpg binary of backend """
+        gpg = self._gpg.get(backend.gpg_binary)
+        if gpg is None:
+            from gpgpool import AsyncGPG
+            gpg = self._gpg[backend.gpg_binary] = AsyncGPG(
+                backend.gpg_binary, self.concurrency, self.gnupg_home)
+        return gpg
+
+    @staticmethod
+    def _matcher(pattern, token):
+        from matchers import RegexpMatcher, TokenMatcher
+        return TokenMatcher(pattern) if token else RegexpMatcher(pattern)
+
+    def _find(self, pattern, token):
+        """ Returns (backend, stored data) for the best match, or None """
+        from backends import find_key
+        found = find_key(self._load(), self._matcher(pattern, token),
+                         pattern)
+        if found is None:
+            return None
+        backend, key = found
+        return backend, backend.stored_for_key(key)
+
+    def _keys(self, pattern, token):
+        from backends import ordered
+        matcher = self._matcher(pattern, token) if pattern else None
+        return [backend.name + "/" + key
+                for backend in ordered(self._load())
+                for key in backend.keys(matcher)]
+
+    async def _content(self, pattern, token):
+        found = await self._search(self._find, pattern, token)
+        if found is None:
+            return None
+        from backends import GPGBackend
+
+        backend, stored = found
+        if isinstance(backend, GPGBackend):
+            return backend, await self.gpg_for(backend).decrypt(stored)
+        return backend, stored
+
+    # Entries ################################################################
+
+    async def get(self, pattern, token=False):
+        """ Returns the password of the entry matching pattern, or None
+
+        With token the ranked token matcher is used instead of a regular
+        expression. Raises GPGError when the entry can't be decrypted.
+        """
+        found = await self._content(pattern, token)
+        if found is None:
+            return None
+        backend, content = found
+        return backend.password_from(content)
+
+    async def show(self, pattern, token=False):
+        """ Returns the entry matching pattern (str), or None """
+        found = await self._content(pattern, token)
+        if found is None:
+            return None
+        return found[1].decode('UTF-8')
+
+    async def content(self, pattern, token=False):
+        """ Returns the entry matching pattern as bytes, or None """
+        found = await self._content(pattern, token)
+        return None if found is None else found[1]
+
+    async def list(self, pattern='', token=False):
+        """ Returns <storage>/<key> for the keys matching pattern (or all)
+        """
+        return await self._search(self._keys, pattern, token)
+
+    async def create(self, storage, key, data, overwrite=False):
+        """ Stores data (str or bytes) as the entry for key in storage
+
+        Raises FileExistsError for an existing entry unless overwrite,
+        KeyError for an unknown storage and ValueError for a key that
+        can't name an entry or a storage key missing in the keyring.
+        """
+        from backends import GPGBackend, checked_key
+
+        backends = await self._search(self._load)
+        backend = backends.get(storage)
+        if backend is None:
+            raise KeyError("No such storage: %s" % storage)
+        name = checked_key(key)
+        if isinstance(data, str):
+            data = data.encode('UTF-8')
+
+        if isinstance(backend, GPGBackend):
+            # Resolved in the keyring of gnupg_home, like gpg runs
+            gpg = self.gpg_for(backend)
+            recipients, stamp = await self._run(backend.cached_recipients,
+                                                self.gnupg_home)
+            if recipients is None:
+                recipients = await gpg.recipients(backend.key_names)
+                await self._run(backend.cache_recipients, recipients, stamp,
+                                self.gnupg_home)
+            data = await gpg.encrypt(data, backend.fingerprints(recipients))
+        # Writers lock the key themselves, searches can go on meanwhile
+        await self._run(backend.write_stored, name, data, overwrite)
@@ -2,15 +2,145 @@
 
 import configparser
 import contextlib
-from io import StringIO
+import errno
+from io import BytesIO, TextIOWrapper
 import logging
 import os
+import stat
 import sys
+import tempfile
+import zlib
+
+import timings
+from cache import BackendManifest, KeyIndex, cache_path, read_json, \
+    stable_mtime, write_json
+from locks import KeyLocks
+from walker import ENTER, LEAVE, is_ignored_directory, key_directories, \
+    key_totals, list_directory
 
 log = logging.getLogger(__name__)
 
 CONFIG_FILE_NAME = "storage.conf"
 
+
+def is_key_name(filename):
+    """ Returns True if filename is an entry and not some other file """
+    return (not filename.startswith('.') and
+            not filename.endswith("~") and
+            not filename.startswith(CONFIG_FILE_NAME))
+
+
+def normalize_key(key):
+    """ Returns key normalized, None if it can't name an entry
+
+    Absolute keys, keys leaving the backend and keys in hidden directories
+    are refused.
+    """
+    key = os.path.normpath(key)
+    parts = key.split(os.sep)
+    if os.path.isabs(key) or '..' in parts or \
+            not is_key_name(parts[-1]) or \
+            any(is_ignored_directory(part) for part in parts[:-1]):
+        return None
+    return key
+
+
+def key_tree(keys):
+    """ Returns (listing, total) like ClearTextBackend.key_tree for keys
+    """
+    directories = key_directories(keys)
+    totals = key_totals(directories)
+    return directories.__getitem__, lambda relative: totals.get(relative, 0)
+
+
+def checked_key(key):
+    """ Returns key normalized, raises ValueError if it can't name an entry
+    """
+    name = normalize_key(key)
+    if name is None:
+        raise ValueError("Invalid key: %s" % key)
+    return name
+
+
+def _new_file_mode():
+    # Reading the umask means setting it, done once before any threads
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# Mode of new entries, the one open() would give them
+NEW_FILE_MODE = _new_file_mode()
+
+
+def atomic_write(path, data, overwrite=False):
+    """ Writes data (bytes) to path so it is either complete or missing
+
+    The data goes to a hidden temporary file in the same directory which
+    then replaces path, or is linked to it when an existing file must not
+    be overwritten (raising FileExistsError). A replaced file keeps its
+    mode, a new one gets the mode the umask allows. A file in the way of
+    the directories raises NotADirectoryError naming that file.
+    """
+    directory = os.path.dirname(path)
+    make_directories(directory)
+    mode = NEW_FILE_MODE
+    if overwrite:
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            pass
+    descriptor, temp_path = tempfile.mkstemp(
+        dir=directory, prefix='.' + os.path.basename(path) + '.',
+        suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as temp_file:
+            # mkstemp creates the file readable by the owner only
+            os.fchmod(temp_file.fileno(), mode)
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        if overwrite:
+            os.replace(temp_path, path)
+        else:
+            os.link(temp_path, path)
+            os.unlink(temp_path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    sync_directory(directory)
+
+
+def make_directories(directory):
+    """ Creates directory and its parents unless they exist """
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except (FileExistsError, NotADirectoryError):
+        blocking = directory
+        while not os.path.lexists(blocking):
+            blocking = os.path.dirname(blocking)
+        if os.path.isdir(blocking):
+            raise
+        raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR),
+                                 blocking)
+
+
+def sync_directory(directory):
+    """ Makes a rename (or link) in directory survive a crash """
+    try:
+        descriptor = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
 # Backends ####################################################################
 
 
@@ -21,6 +151,8 @@ class BaseBackend(object):
         self.config = config
         self.name = os.path.basename(root_folder)
         self.trivial_path = root_folder
+        # Backends with a higher priority win when several have a match
+        self.priority = config.getint('backend', 'priority', fallback=0)
 
     def list(self):
         return []
@@ -40,121 +172,319 @@ class ClearTextBackend(BaseBackend):
         super(ClearTextBackend, self).__init__(root_folder, config)
         self.log = logging.getLogger('backends.ClearText')
 
+    _index = None
+    _ngrams = None
+    _locks = None
+
+    # Set by long running users (the daemon), a trigram index only pays
+    # off over many lookups, a single one scores every key faster
+    use_ngrams = False
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = KeyIndex(self.root, counted=is_key_name)
+        return self._index
+
+    @property
+    def lock(self):
+        """ Call with a key for a context manager holding its write lock
+
+        The lock files live with the caches, they only have to be shared
+        by the processes of this host and the backend stays clean.
+        """
+        if self._locks is None:
+            self._locks = KeyLocks(cache_path('locks', self.root, suffix=''))
+        return self._locks
+
+    @property
+    def ngrams(self):
+        """ Trigram index of the keys, rebuilt when the key index changes """
+        index = self.index
+        if not index.loaded or index.stale:
+            index.update()
+        if self._ngrams is None or self._ngrams[0] != index.generation:
+            from matchers import NGramIndex
+            keys = (key for key, name in index.keys() if is_key_name(name))
+            self._ngrams = (index.generation, NGramIndex(keys))
+        return self._ngrams[1]
+
     def list(self):
         """ Returns an iterator for all the keys for this storage """
-        walker = os.walk(self.root, followlinks=True)
-        for path, subs, files in walker:
-            for file in files:
-                if (not file.startswith('.') and
-                        not file.endswith("~") and
-                        not file.startswith(CONFIG_FILE_NAME)):
-                    yield os.path.join(path, file)
+        for key, name in self.index.keys():
+            if is_key_name(name):
+                yield self.path_for_key(key)
 
+    @timings.measured('walk')
     def filter(self, output, matcher=None):
-        walker = os.walk(self.root, followlinks=True)
-        common_path = self.root.split(os.sep)
+        subject = self._subject(matcher)
+        matcher = timings.timed(matcher)
         output.start_backend(self.name)
-        for path, subs, files in walker:
-            current_path = path.split(os.sep)
-            # print(current_path, common_path)
-            old_dirs = common_path.copy()
-            new_dirs = current_path.copy()
-            while (len(old_dirs) and len(new_dirs) and
-                    old_dirs[0] == new_dirs[0]):
-                old_dirs.pop(0)
-                new_dirs.pop(0)
-
-            for _ in old_dirs:
+        for event, key, name, last in self.index.events():
+            if ENTER == event:
+                output.start_sub(name, last=last)
+            elif LEAVE == event:
                 output.end_sub()
-            for name in new_dirs:
-                output.start_sub(name)
-
-            common_path = current_path
-
-            for filename in files:
-                if (not filename.startswith('.') and not filename.endswith("~") and
-                        not filename.startswith(CONFIG_FILE_NAME)):
-                    key = os.path.join(path, filename)
-                    if matcher is None or matcher.matches(key):
-                        output.key(filename)
+            elif is_key_name(name):
+                if matcher is None or matcher.matches(subject(key)):
+                    output.key(name, last)
+        output.end_backend()
 
-        root_list = self.root.split(os.sep)
-        for _ in range(0, len(common_path) - len(root_list)):
-            output.end_sub()
+    @timings.measured('walk')
+    def outline(self, output, matcher=None, max_depth=None, summary=False):
+        """ Renders the keys down to max_depth levels, with key counts
+
+        Directories on the last level are shown with the number of keys
+        below them instead of being expanded, with summary only the
+        directories are shown. Without a matcher the counts come from the
+        index, only the directories shown are looked at.
+        """
+        listing, total = self.key_tree(matcher)
+        if not total(''):
+            return
+
+        def expand(relative, level):
+            subs, names = listing(relative)
+            if summary:
+                names = []
+            subs = [name for name in subs
+                    if total(os.path.join(relative, name))]
+            # Everything shown is known, so is the last of the siblings
+            final = len(names) + len(subs) - 1
+            for position, name in enumerate(names):
+                output.key(name, position == final)
+            for position, name in enumerate(subs, len(names)):
+                path = os.path.join(relative, name)
+                count = total(path)
+                last = position == final
+                if (max_depth is None or level + 1 < max_depth) and \
+                        (not summary or any(
+                            total(os.path.join(path, sub))
+                            for sub in listing(path)[0])):
+                    output.start_sub(name, count, last)
+                    expand(path, level + 1)
+                    output.end_sub()
+                else:
+                    output.directory(name, count, last)
+
+        output.start_backend(self.name, total(''))
+        output.show()
+        if max_depth is None or max_depth > 0:
+            expand('', 0)
         output.end_backend()
 
-    def _matching_keys(self, matcher):
-        walker = os.walk(self.root, followlinks=True)
-        root_len = len(self.root)
-        for path, subs, files in walker:
-            for filename in files:
-                if (not filename.startswith('.') and
-                        not filename.startswith(CONFIG_FILE_NAME)):
-                    abs_path = os.path.join(path, filename)
-                    key = abs_path[root_len+1:]
-                    if matcher is None or matcher.matches(key):
-                        yield(key)
+    def key_tree(self, matcher=None):
+        """ Returns (listing, total) for the keys matching matcher
+
+        listing(directory) returns its (sub directories, key names) and
+        total(directory) the number of keys in and below it. Without a
+        matcher both read the index, which keeps the counts.
+        """
+        if matcher is not None:
+            return key_tree(self.keys(matcher))
+        index = self.index
+
+        def listing(relative):
+            subs, files, _ = index.listing(relative)
+            return subs, [name for name in files if is_key_name(name)]
+
+        def total(relative):
+            entry = index.listing(relative)
+            return 0 if entry is None else entry[2]
+
+        return listing, total
+
+    def keys(self, matcher=None):
+        """ Yields the keys relative to the root, matched like in filter """
+        subject = self._subject(matcher)
+        matcher = timings.timed(matcher)
+        for key, name in self.index.keys():
+            if is_key_name(name):
+                if matcher is None or matcher.matches(subject(key)):
+                    yield key
+
+    def _subject(self, matcher):
+        """ Returns what matcher is given for a key when listing
+
+        Regular expressions see the path of the entry, ranked matchers
+        the key like in match: a word in the path of the backend would
+        match every key.
+        """
+        if getattr(matcher, 'ranked', False):
+            return lambda key: key
+        return self.path_for_key
+
+    def _matching_keys(self, matcher, cancel=None):
+        matcher = timings.timed(matcher)
+        for key, name in self.index.keys():
+            if cancel is not None and cancel.is_set():
+                return
+            if is_key_name(name):
+                if matcher is None or matcher.matches(key):
+                    yield(key)
 
     def path_for_key(self, key):
         return os.path.join(self.root, key)
 
+    def lookup(self, key):
+        """ Returns key (normalized) if it names an entry in this backend
+
+        Costs a single stat, keys outside the backend or in hidden
+        directories are never found.
+        """
+        key = normalize_key(key)
+        if key is not None and os.path.isfile(self.path_for_key(key)):
+            return key
+
+    def entry_stamp(self, key):
+        """ Returns what changes whenever the entry for key changes """
+        status = os.stat(self.path_for_key(key))
+        return (status.st_ino, status.st_size, status.st_mtime_ns)
+
     @contextlib.contextmanager
     def storage_for_key(self, key, mode="r"):
-        storage_path = self.path_for_key(key)
-        if mode != 'r':
-            directory = os.path.dirname(storage_path)
-            if os.path.exists(directory):
-                if not os.path.isdir(os.path.dirname(storage_path)):
-                    log.error("Cant't create directory, file already exists"
-                              "with the same name")
-                    raise Exception
+        """ Yields a file object for the entry for key
+
+        Written entries are kept in memory and stored when the with block
+        is left without an exception, mode "x" fails with FileExistsError
+        for an existing entry and "a" appends to it under its lock.
+        """
+        binary = 'b' in mode
+        if 'r' in mode:
+            with self.reader_for_key(key) as reader:
+                yield reader if binary else TextIOWrapper(reader,
+                                                         encoding='UTF-8')
+            return
+
+        with contextlib.ExitStack() as stack:
+            storage = BytesIO()
+            if 'a' in mode:
+                stack.enter_context(self.lock(key))
+                try:
+                    storage.write(self.content_for_key(key))
+                except FileNotFoundError:
+                    pass
+            if binary:
+                yield storage
             else:
-                log.info("Creating directory: %s", directory)
-                os.makedirs(directory)
-        log.debug("Opening %s mode %s", storage_path, mode)
-        with open(storage_path, mode) as storage_file:
-            yield storage_file
+                text = TextIOWrapper(storage, encoding='UTF-8')
+                yield text
+                text.flush()
+            log.debug("Storing %s mode %s", key, mode)
+            self.write_entry(key, storage.getvalue(),
+                             overwrite='x' not in mode)
+
+    def match(self, matcher, cancel=None):
+        """ Returns (score, key) for the best matching key or None
+
+        Ranking matchers pick the best key from the trigram index with
+        use_ngrams or else score all the keys, other matchers take the
+        first key found with a score of None. The scan gives up, returning
+        None, once the event cancel is set.
+        """
+        if getattr(matcher, 'ranked', False):
+            keys = self.ngrams if self.use_ngrams else self.keys()
+            for score, key in timings.timed(matcher).best(keys, 1):
+                return score, key
+            return None
+
+        for key in self._matching_keys(matcher, cancel):
+            return None, key
+
+    @contextlib.contextmanager
+    def reader_for_key(self, key):
+        """ Yields the entry for key as a binary file object """
+        with open(self.path_for_key(key), 'rb') as entry:
+            yield entry
+
+    def password_for_key(self, key):
+        with self.reader_for_key(key) as reader:
+            return self.password_from(reader.readline())
+
+    def password_from(self, content):
+        """ Returns the password, the first line of content (bytes)
+
+        Entries may be binary, what isn't UTF-8 is replaced.
+        """
+        line = content.split(b'\n', 1)[0]
+        return line.decode('UTF-8', 'replace').rstrip(self.ignore_chars)
+
+    def content_for_key(self, key):
+        """ Returns the entry for key as bytes """
+        with self.reader_for_key(key) as reader:
+            return reader.read()
+
+    def stored_for_key(self, key):
+        """ Returns the entry for key as stored, encrypted or not """
+        with open(self.path_for_key(key), 'rb') as entry:
+            return entry.read()
+
+    def entry_for_key(self, key):
+        return self.content_for_key(key).decode('UTF-8')
 
     def get_password(self, matcher):
         """ Returns the password (first line) for the given key """
-        password = None
-        for key in self._matching_keys(matcher):
-            with self.storage_for_key(key) as storage:
-                password = storage.readline().rstrip(self.ignore_chars)
-
-            return password
+        match = self.match(matcher)
+        if match is not None:
+            return self.password_for_key(match[1])
 
     def get_entry(self, matcher):
         """ Returns the entry for the given key """
-        for key in self._matching_keys(matcher):
-            with self.storage_for_key(key) as storage:
-                return storage.read()
+        match = self.match(matcher)
+        if match is not None:
+            return self.entry_for_key(match[1])
+
+    def read_entries(self, keys, workers=None):
+        """ Yields (key, content) for the given keys, content as bytes
+
+        An entry that can not be read yields the exception instead.
+        """
+        for key in keys:
+            try:
+                with open(self.path_for_key(key), 'rb') as storage:
+                    yield key, storage.read()
+            except OSError as error:
+                yield key, error
+
+    def write_entry(self, key, data, overwrite=False):
+        """ Atomically stores data (bytes) as the entry for key """
+        self.write_stored(key, data, overwrite)
+
+    def write_stored(self, key, data, overwrite=False):
+        """ Atomically stores data (bytes) for key as it is, unencrypted
+
+        Writers of the same key take turns, the directories are created
+        as needed. A file in the way of a directory raises
+        NotADirectoryError, a key that can't name an entry ValueError.
+        """
+        key = checked_key(key)
+        with self.lock(key):
+            atomic_write(self.path_for_key(key), data, overwrite)
+        self.index.stale = True
+
+    def write_entries(self, items, workers=None, overwrite=False):
+        """ Stores (key, data) items, yields (key, None or the exception)
+        """
+        for key, data in items:
+            try:
+                self.write_entry(key, data, overwrite)
+                yield key, None
+            except OSError as error:
+                yield key, error
 
     def create(self, key):
-        content = sys.stdin.read()
-        with self.storage_for_key(key, mode="x") as storage:
-            storage.write(content)
+        self.write_entry(key, sys.stdin.buffer.read())
 
 
 class GPGBackend(ClearTextBackend):
 
-    _gpg = None
     default_gpg_binary = "gpg"
 
-    @property
-    def gpg(self):
-        if self._gpg is None:
-            import gnupg
-            self._gpg = gnupg.GPG(use_agent=True,
-                                  gpgbinary=self.gpg_binary)
-
-        return self._gpg
-
     def __init__(self, root_folder, config, gpg_binary=None):
         super(GPGBackend, self).__init__(root_folder, config)
 
         self.key_names = set(config.get('gpg', 'keys').strip().split('\n'))
-        self.keys = list()
+        self._recipients = None
 
         if gpg_binary is not None:
             self.gpg_binary = gpg_binary
@@ -164,82 +494,515 @@ class GPGBackend(ClearTextBackend):
         self.gpg_binary = config.get('gpg', 'gpg-binary',
                                      fallback=self.gpg_binary)
 
-        for key in self.gpg.list_keys():
-            for uid in key.get('uids', []):
-                if uid in self.key_names:
-                    self.keys.append(key)
-                    continue
-        log.debug("Keys for storage: %s", self.keys)
-        os.environ["PINENTRY_USER_DATA"] = "USE_CURSES=0"
-
-    @contextlib.contextmanager
-    def storage_for_key(self, key, mode="r"):
-        if mode != "r":
-            storage = StringIO()
-            yield storage
+    def _recipient_stamp(self, gnupg_home):
+        """ Modification times that invalidate the cached recipients """
+        paths = [os.path.join(self.root, CONFIG_FILE_NAME)]
+        paths.extend(os.path.join(gnupg_home, name)
+                     for name in ('pubring.kbx', 'pubring.gpg'))
+        stamp = []
+        for path in paths:
+            try:
+                stamp.append(os.stat(path).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    def _recipient_path(self, gnupg_home):
+        # One cache per keyring, the uids may name other keys in another
+        checksum = zlib.crc32(gnupg_home.encode('UTF-8'))
+        return cache_path('recipients-%08x' % checksum, self.root)
+
+    def cached_recipients(self, gnupg_home=None):
+        """ Returns (recipients or None, stamp) for the keyring in
+        gnupg_home (GNUPGHOME by default)
+
+        The recipients are None when they have to be resolved again, the
+        stamp is passed on to cache_recipients then.
+        """
+        from gpgpool import gnupg_directory
+        gnupg_home = gnupg_directory(gnupg_home)
+        stamp = self._recipient_stamp(gnupg_home)
+        cached = read_json(self._recipient_path(gnupg_home))
+        if cached is not None and cached.get('root') == self.root and \
+                cached.get('gnupg_home') == gnupg_home and \
+                cached.get('stamp') == stamp and \
+                cached.get('key_names') == sorted(self.key_names):
+            return cached['recipients'], stamp
+        return None, stamp
+
+    def cache_recipients(self, recipients, stamp, gnupg_home=None):
+        """ Saves the recipients resolved in the keyring in gnupg_home """
+        from gpgpool import gnupg_directory
+        gnupg_home = gnupg_directory(gnupg_home)
+        try:
+            write_json(self._recipient_path(gnupg_home),
+                       {'root': self.root,
+                        'gnupg_home': gnupg_home,
+                        'stamp': stamp,
+                        'key_names': sorted(self.key_names),
+                        'recipients': recipients})
+        except OSError as error:
+            log.warning("Could not cache recipients: %s", error)
 
-            encrypted_data = self.encrypt(storage.getvalue())
-            with super(GPGBackend, self).storage_for_key(key, mode) as storage:
-                storage.write(str(encrypted_data))
-        else:
-            with super(GPGBackend, self).storage_for_key(key, mode) as storage:
-                log.debug("The storage: %s", storage)
-                decrypted_data = self.decrypt(storage.read())
-                yield StringIO(str(decrypted_data))
+    @property
+    def recipients(self):
+        """ Fingerprints for the configured keys, by uid
+
+        Resolving the uids needs gpg to list the keyring so it is done on
+        first use and cached until storage.conf or the keyring changes.
+        """
+        if self._recipients is not None:
+            return self._recipients
+
+        self._recipients, stamp = self.cached_recipients()
+        if self._recipients is None:
+            with self.gpg_pool(1) as pool:
+                self._recipients = pool.recipients(self.key_names)
+            self.cache_recipients(self._recipients, stamp)
+
+        log.debug("Keys for storage: %s", self._recipients)
+        return self._recipients
+
+    def reader_for_key(self, key):
+        """ Yields a reader of the entry for key, decrypted as it is read
+        """
+        return self.gpg_pool(1).decrypt_reader(self.path_for_key(key))
+
+    def fingerprints(self, recipients=None):
+        """ Returns the fingerprints to encrypt to, all keys must exist
+
+        recipients are the ones of the keyring in GNUPGHOME by default.
+        """
+        if recipients is None:
+            recipients = self.recipients
+        missing = self.key_names.difference(recipients)
+        if missing:
+            log.error("Keys not found in keychain: %s",
+                      ", ".join(sorted(missing)))
+            raise ValueError('Missing keys in keychain')
+        return sorted(set(recipients.values()))
 
     def encrypt(self, data):
-        if len(self.keys) != len(self.key_names):
-            print(self.key_names)
-            raise ValueError('Missing keys in keychain')
-        keys = [k['keyid'] for k in self.keys]
-        encrypted_data = self.gpg.encrypt(data, keys, always_trust=True)
-        return encrypted_data
+        """ Encrypts data (bytes) to the storage keys, returns bytes """
+        return self.gpg_pool(1).encrypt(data, self.fingerprints())
 
     def decrypt(self, data):
-        decrypted_data = self.gpg.decrypt(data)
-        return decrypted_data
+        """ Decrypts data (bytes), returns bytes """
+        return self.gpg_pool(1).decrypt(data)
+
+    def gpg_pool(self, workers=None):
+        from gpgpool import GPGPool
+        return GPGPool(self.gpg_binary, workers=workers)
+
+    def read_entries(self, keys, workers=None):
+        """ Decrypts the given keys in parallel, yields (key, content) """
+        with self.gpg_pool(workers) as pool:
+            yield from pool.decrypt_files(
+                (key, self.path_for_key(key)) for key in keys)
+            log.debug("Decryption: %s", pool.stats())
+
+    def write_entry(self, key, data, overwrite=False):
+        """ Encrypts data (bytes) and atomically stores it for key """
+        key = checked_key(key)
+        self.write_stored(key, self.encrypt(data), overwrite)
+
+    def write_entries(self, items, workers=None, overwrite=False):
+        """ Encrypts and stores (key, data) items in parallel """
+        recipients = self.fingerprints()
+
+        def write(item):
+            key, data = item
+            self.write_stored(key, pool.encrypt(data, recipients), overwrite)
+
+        with self.gpg_pool(workers) as pool:
+            yield from pool.run(write, ((item[0], item) for item in items))
+            log.debug("Encryption: %s", pool.stats())
+
+    def reencrypt_entry(self, key, pool, expected, dry_run=False):
+        """ Re-encrypts key unless it is encrypted to the expected keys
+
+        expected maps the fingerprint of every recipient to the ids of its
+        encryption keys. Only the packet headers are read to decide, the
+        entry is then decrypted and atomically replaced. Returns True if
+        the entry was (or with dry_run would be) re-encrypted.
+        """
+        from gpgpool import matches_recipients, recipient_key_ids
+
+        path = self.path_for_key(key)
+        with open(path, 'rb') as entry:
+            before = os.fstat(entry.fileno())
+            key_ids = recipient_key_ids(entry)
+        if matches_recipients(key_ids, expected):
+            return False
+        if dry_run:
+            return True
+
+        encrypted = pool.encrypt(pool.decrypt(path=path), sorted(expected))
+        # Other writers only replace the entry under its lock
+        with self.lock(key):
+            after = os.stat(path)
+            if (before.st_ino, before.st_size, before.st_mtime_ns) != \
+                    (after.st_ino, after.st_size, after.st_mtime_ns):
+                raise OSError("Entry changed while it was re-encrypted")
+            atomic_write(path, encrypted, overwrite=True)
+        return True
+
+
+class PackedBackend(ClearTextBackend):
+    """ Keeps all entries in a single pack file with a sorted index
+
+    Looking up an entry costs a binary search in the mmap'ed index instead
+    of a stat and an open per entry, listing needs no directory walk.
+    Replaced and deleted entries stay in the pack until it is compacted.
+    """
+
+    # Entries written together in one append when storing many
+    batch_size = 256
 
+    def __init__(self, root_folder, config):
+        super(PackedBackend, self).__init__(root_folder, config)
+        self.log = logging.getLogger('backends.Packed')
 
-# Helpers #####################################################################
+    _pack = None
 
-_backends = None
+    @property
+    def index(self):
+        if self._pack is None:
+            from packed import Pack
+            self._pack = Pack(self.root)
+        return self._pack
 
+    def encode(self, data):
+        """ Returns data (bytes) as stored in the pack """
+        return data
 
-def get_backends(directory):
-    global _backends
-    if _backends is not None:
-        return _backends
+    def decode(self, data):
+        """ Returns the content of data as stored in the pack """
+        return data
 
-    log = logging.getLogger('backends.get_backends')
-    backends = {}
+    def lookup(self, key):
+        key = normalize_key(key)
+        if key is not None and self.index.locate(key) is not None:
+            return key
 
-    directory = os.path.expanduser(directory)
-    walker = os.walk(directory, followlinks=True)
+    def entry_stamp(self, key):
+        location = self.index.locate(key)
+        if location is None:
+            raise FileNotFoundError(errno.ENOENT, "No such entry", key)
+        return (self.index.inode,) + location
 
-    log.debug('Walking %s', directory)
-    for path, subdirs, files in walker:
-        if CONFIG_FILE_NAME in files:
-            del subdirs[:]
+    def content_for_key(self, key):
+        return self.decode(self.index.read(key))
 
-            log.debug("Found backend %s", path)
+    def stored_for_key(self, key):
+        return self.index.read(key)
+
+    @contextlib.contextmanager
+    def reader_for_key(self, key):
+        yield BytesIO(self.content_for_key(key))
 
-            config_file = os.path.join(path, CONFIG_FILE_NAME)
-            config = configparser.SafeConfigParser()
-            config.read(config_file)
+    def key_tree(self, matcher=None):
+        return key_tree(self.keys(matcher))
 
+    def read_entries(self, keys, workers=None):
+        for key in keys:
             try:
-                backend_type = config.get('backend', 'type')
-                if backend_type == 'cleartext':
-                    backend = ClearTextBackend(path, config)
-                elif backend_type == 'gpg':
-                    backend = GPGBackend(path, config)
-
-                backends[backend.name] = backend
-            except configparser.NoSectionError:
-                log.error('No backend section in configuration %s',
+                yield key, self.content_for_key(key)
+            except OSError as error:
+                yield key, error
+
+    def encode_entries(self, items, workers=None):
+        """ Yields (key, encoded data or the exception) for (key, data) """
+        for key, data in items:
+            yield key, self.encode(data)
+
+    def write_entry(self, key, data, overwrite=False):
+        for _, error in self.write_entries([(key, data)], 1, overwrite):
+            if error is not None:
+                raise error
+
+    def write_stored(self, key, data, overwrite=False):
+        key = checked_key(key)
+        # Checked under the pack lock, FileExistsError for an existing key
+        self.index.append([(key, data)],
+                          None if overwrite else {key: None})
+
+    def write_entries(self, items, workers=None, overwrite=False):
+        """ Stores (key, data) items, appending them in batches """
+        items = ((checked_key(key), data) for key, data in items)
+        batch = []
+
+        def append(batch):
+            # Without overwrite the keys must still be missing under the
+            # pack lock, not just when they were looked up
+            expected = None if overwrite else {key: None for key, _ in batch}
+            self.index.append(batch, expected)
+
+        def store(batch):
+            try:
+                append(batch)
+                return [(key, None) for key, _ in batch]
+            except FileExistsError as error:
+                if len(batch) == 1:
+                    return [(batch[0][0], error)]
+            except OSError as error:
+                return [(key, error) for key, _ in batch]
+            # Another writer stored some of the keys, store the rest
+            results = []
+            for item in batch:
+                try:
+                    append([item])
+                    results.append((item[0], None))
+                except OSError as error:
+                    results.append((item[0], error))
+            return results
+
+        for key, data in self.encode_entries(items, workers):
+            if isinstance(data, Exception):
+                yield key, data
+            elif not overwrite and (self.lookup(key) is not None or
+                                    key in (k for k, _ in batch)):
+                yield key, FileExistsError(errno.EEXIST, "Entry exists", key)
+            else:
+                batch.append((key, data))
+                if len(batch) >= self.batch_size:
+                    yield from store(batch)
+                    batch = []
+        if batch:
+            yield from store(batch)
+
+    def delete(self, key):
+        self.index.append([(key, None)])
+
+    def compact(self):
+        """ Drops replaced and deleted entries, returns the sizes """
+        return self.index.compact()
+
+
+class PackedGPGBackend(PackedBackend, GPGBackend):
+    """ Packed backend encrypting every entry on its own """
+
+    def encode(self, data):
+        return self.encrypt(data)
+
+    def decode(self, data):
+        return self.decrypt(data)
+
+    def read_entries(self, keys, workers=None):
+        """ Decrypts the given keys in parallel, yields (key, content) """
+        with self.gpg_pool(workers) as pool:
+            yield from pool.run(
+                lambda key: pool.decrypt(self.index.read(key)),
+                ((key, key) for key in keys))
+
+    def encode_entries(self, items, workers=None):
+        recipients = self.fingerprints()
+        with self.gpg_pool(workers) as pool:
+            yield from pool.run(
+                lambda data: pool.encrypt(data, recipients), items)
+
+    def reencrypt_entry(self, key, pool, expected, dry_run=False):
+        from gpgpool import matches_recipients, recipient_key_ids
+
+        location = self.index.locate(key)
+        data = self.index.read(key)
+        if matches_recipients(recipient_key_ids(BytesIO(data)), expected):
+            return False
+        if dry_run:
+            return True
+
+        encrypted = pool.encrypt(pool.decrypt(data), sorted(expected))
+        self.index.append([(key, encrypted)], expected={key: location})
+        return True
+
+
+# Helpers #####################################################################
+
+_backends = None
+
+
+@timings.measured('discovery')
+def discover_backends(directory):
+    """ Searches directory for backends, returns (dirs, backends)
+
+    dirs maps every directory that was searched (but isn't a backend) to
+    its mtime (None when it is missing or can't be listed), backends has
+    a record with the path and the parsed configuration of every backend,
+    as stored in the manifest.
+    """
+    dirs = {}
+    backends = []
+    pending = [directory]
+    while pending:
+        path = pending.pop()
+        try:
+            mtime = stable_mtime(path)
+            subdirs, files = list_directory(path, root=directory)
+        except OSError as error:
+            log.debug("Can't search %s: %s", path, error)
+            # An unknown mtime, so the next run searches again once the
+            # directory exists (or can be listed)
+            dirs[path] = None
+            continue
+
+        if CONFIG_FILE_NAME not in files:
+            dirs[path] = mtime
+            pending.extend(os.path.join(path, sub)
+                           for sub in reversed(subdirs))
+            continue
+
+        log.debug("Found backend %s", path)
+        config_file = os.path.join(path, CONFIG_FILE_NAME)
+        config = configparser.SafeConfigParser()
+        config.read(config_file)
+        backends.append({
+            'path': path,
+            'config_file': config_file,
+            'mtime': stable_mtime(config_file),
+            'config': {section: dict(config.items(section, raw=True))
+                       for section in config.sections()},
+        })
+
+    return dirs, backends
+
+
+def get_backends(directory, reload=False):
+    """ Returns {name: backend} for the backends below directory
+
+    The backends are loaded once per process, see load_backends.
+    """
+    global _backends
+    if _backends is None or reload:
+        _backends = load_backends(directory)
+    return _backends
+
+
+@timings.measured('backends')
+def load_backends(directory):
+    """ Returns {name: backend} for the backends below directory
+
+    The backends found are remembered in a manifest, the storage directory
+    is only searched again when something in it changed.
+    """
+    log = logging.getLogger('backends.load_backends')
+    backends = {}
+
+    directory = os.path.abspath(os.path.expanduser(directory))
+    manifest = BackendManifest(directory)
+    records = manifest.load()
+    if records is None:
+        log.debug('Searching %s', directory)
+        dirs, records = discover_backends(directory)
+        manifest.save(dirs, records)
+
+    for record in records:
+        path = record['path']
+        config_file = record['config_file']
+        config = configparser.SafeConfigParser()
+        config.read_dict(record['config'])
+
+        try:
+            backend_type = config.get('backend', 'type')
+            if backend_type == 'cleartext':
+                backend = ClearTextBackend(path, config)
+            elif backend_type == 'gpg':
+                backend = GPGBackend(path, config)
+            elif backend_type == 'packed':
+                backend = PackedBackend(path, config)
+            elif backend_type == 'packed-gpg':
+                backend = PackedGPGBackend(path, config)
+            else:
+                log.error('Unknown backend type %s in %s', backend_type,
                           config_file)
-            except configparser.NoOptionError as error:
-                log.error(error)
+                continue
+
+            backends[backend.name] = backend
+        except configparser.NoSectionError:
+            log.error('No backend section in configuration %s',
+                      config_file)
+        except configparser.NoOptionError as error:
+            log.error(error)
+        except ValueError as error:
+            log.error('Invalid configuration %s: %s', config_file, error)
 
-    _backends = backends
     return backends
+
+
+def ordered(backends):
+    """ Returns the backends by priority (highest first), then by name """
+    return sorted(backends.values(),
+                  key=lambda backend: (-backend.priority, backend.name))
+
+
+def find_exact_key(backends, pattern):
+    """ Returns (backend, key) if pattern names an entry, or None
+
+    pattern is either a key in one of the backends or <storage>/<key>.
+    """
+    for backend in ordered(backends):
+        key = backend.lookup(pattern)
+        if key is not None:
+            return backend, key
+
+    storage, _, key = pattern.partition('/')
+    backend = backends.get(storage)
+    if backend is not None and key:
+        key = backend.lookup(key)
+        if key is not None:
+            return backend, key
+
+
+@timings.measured('search')
+def find_key(backends, matcher, pattern=None):
+    """ Returns (backend, key) for the entry matching best, or None
+
+    A pattern naming an entry exactly is looked up directly, without
+    walking any backend. Otherwise all backends are searched at the same
+    time. With a ranking matcher the best score wins, with other matchers
+    the first match in the backend with the highest priority. Equal
+    scores are decided by priority too, and searches that can no longer
+    win are cancelled.
+    """
+    if pattern:
+        found = find_exact_key(backends, pattern)
+        if found is not None:
+            return found
+
+    candidates = ordered(backends)
+    if len(candidates) == 1:
+        match = candidates[0].match(matcher)
+        return None if match is None else (candidates[0], match[1])
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    import threading
+
+    pending = object()
+    results = [pending] * len(candidates)
+    ranked = getattr(matcher, 'ranked', False)
+    cancel = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max(1, len(candidates)),
+                                  thread_name_prefix='search')
+    try:
+        futures = {executor.submit(backend.match, matcher, cancel): position
+                   for position, backend in enumerate(candidates)}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            if ranked:
+                continue
+            # The first match is definitive once every backend with a
+            # higher priority has come up empty
+            for position, result in enumerate(results):
+                if result is pending:
+                    break
+                if result is not None:
+                    return candidates[position], result[1]
+    finally:
+        cancel.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    best = None
+    for backend, result in zip(candidates, results):
+        if result is not None and (best is None or result[0] > best[0]):
+            best = (result[0], backend, result[1])
+    if best is not None:
+        return best[1:]
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8
+""" Generates a synthetic store for benchmarks
+
+The storage directory gets a cleartext and a GPG backend holding the same
+keys, spread over directories of the given depth. The GPG backend is
+encrypted to a passphrase-less key in a throwaway GNUPGHOME next to the
+storage, so the real keyring is never touched.
+"""
+
+import argparse
+import itertools
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RECIPIENT = 'bench@example.invalid'
+
+# Encrypting every entry of a large store would take longer than the
+# benchmarks, the GPG entries cycle through this many encrypted contents
+TEMPLATES = 32
+
+CLEARTEXT_CONFIG = """[backend]
+type = cleartext
+"""
+
+GPG_CONFIG = """[backend]
+type = gpg
+
+[gpg]
+keys = %s
+""" % RECIPIENT
+
+
+def key_names(count, depth=2, fanout=10):
+    """ Returns count keys, each depth directories deep
+
+    Every level has up to fanout directories, the keys are distributed
+    evenly over the directories at the bottom.
+    """
+    keys = []
+    for number in range(count):
+        parts = []
+        value = number
+        for level in range(depth):
+            parts.append("group%d-%d" % (level, value % fanout))
+            value //= fanout
+        parts.append("key%06d" % number)
+        keys.append('/'.join(parts))
+    return keys
+
+
+def contents(count=TEMPLATES):
+    """ Returns count different entries (as bytes) """
+    return [("password%d\nuser: user%d\nurl: https://host%d.example.invalid/\n"
+             % (number, number, number)).encode('UTF-8')
+            for number in range(count)]
+
+
+def create_gnupg_home(directory):
+    """ Creates a GNUPGHOME with a passphrase-less key, returns its path """
+    home = os.path.join(directory, 'gnupg')
+    os.makedirs(home, mode=0o700)
+    subprocess.run(['gpg', '--homedir', home, '--batch', '--quiet',
+                    '--passphrase', '', '--quick-gen-key', RECIPIENT,
+                    'future-default', 'default', 'never'],
+                   check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    return home
+
+
+def stop_agent(home):
+    """ Stops the gpg-agent started for the throwaway GNUPGHOME """
+    subprocess.run(['gpgconf', '--homedir', home, '--kill', 'gpg-agent'],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def write_backend(root, config, keys, entries):
+    """ Creates a backend in root with the entries cycled over keys """
+    os.makedirs(root)
+    with open(os.path.join(root, 'storage.conf'), 'w') as config_file:
+        config_file.write(config)
+    for key, entry in zip(keys, itertools.cycle(entries)):
+        path = os.path.join(root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as entry_file:
+            entry_file.write(entry)
+
+
+def encrypt(entries, gnupg_home):
+    """ Returns the entries encrypted to RECIPIENT, in parallel """
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from gpgpool import GPGPool
+
+    with GPGPool(gnupg_home=gnupg_home) as pool:
+        encrypted = dict(pool.run(
+            lambda entry: pool.encrypt(entry, [RECIPIENT]),
+            enumerate(entries)))
+    for number, entry in encrypted.items():
+        if isinstance(entry, Exception):
+            raise entry
+    return [encrypted[number] for number in range(len(entries))]
+
+
+def generate(directory, count=1000, depth=2, fanout=10, gpg=True):
+    """ Creates a store in directory and returns what the benchmarks need
+
+    The result has the storage directory, the GNUPGHOME (None without the
+    GPG backend), the backend names and the keys.
+    """
+    storage = os.path.join(directory, 'storage')
+    keys = key_names(count, depth, fanout)
+    entries = contents(min(count, TEMPLATES))
+
+    write_backend(os.path.join(storage, 'cleartext'), CLEARTEXT_CONFIG,
+                  keys, entries)
+    backends = ['cleartext']
+
+    gnupg_home = None
+    if gpg:
+        gnupg_home = create_gnupg_home(directory)
+        write_backend(os.path.join(storage, 'gpg'), GPG_CONFIG, keys,
+                      encrypt(entries, gnupg_home))
+        backends.append('gpg')
+
+    return {
+        'storage': storage,
+        'gnupg_home': gnupg_home,
+        'backends': backends,
+        'keys': keys,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('directory', help='where to create the store')
+    parser.add_argument('-n', '--keys', type=int, default=1000,
+                        help='number of keys per backend')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='directories above every key')
+    parser.add_argument('--fanout', type=int, default=10,
+                        help='directories per level')
+    parser.add_argument('--no-gpg', action='store_true',
+                        help='only create the cleartext backend')
+    args = parser.parse_args()
+
+    store = generate(args.directory, args.keys, args.depth, args.fanout,
+                     gpg=not args.no_gpg)
+    print("storage: %s" % store['storage'])
+    if store['gnupg_home'] is not None:
+        print("GNUPGHOME=%s" % store['gnupg_home'])
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
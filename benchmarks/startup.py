@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8
+""" Measures the cold startup of password_store.py against a budget
+
+Every command is run a number of times in a fresh interpreter with
+``-X importtime``. The median wall time and the time spent importing are
+compared with the budget and the script exits non-zero when a command is
+over it, the slowest imports are listed to show where the time went.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'password_store.py')
+
+# Budget in milliseconds for (wall time, import time) of each command, the
+# import time includes the interpreter's own site imports
+BUDGET = {
+    'get': (150, 60),
+    'show': (150, 60),
+    'list': (150, 60),
+    'help': (120, 45),
+}
+
+COMMANDS = {
+    'get': ['get', 'some/key'],
+    'show': ['show', 'some/key'],
+    'list': ['list'],
+    'help': ['--help'],
+}
+
+
+def parse_importtime(stderr):
+    """ Returns {module: (self us, cumulative us)} for top level imports """
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # Nested imports are indented below the module importing them
+        if name.rstrip().startswith('   '):
+            continue
+        imports[name.strip()] = (int(self_us), int(cumulative_us))
+    return imports
+
+
+def run(command, directory, environment):
+    arguments = [sys.executable, '-X', 'importtime', '-W', 'ignore', SCRIPT,
+                 '--no-daemon',
+                 '-c', os.path.join(directory, 'configuration'),
+                 '-d', os.path.join(directory, 'storage')] + command
+    start = time.perf_counter()
+    process = subprocess.run(arguments, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, env=environment,
+                             universal_newlines=True)
+    wall = (time.perf_counter() - start) * 1000
+    imports = parse_importtime(process.stderr)
+    return wall, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=5,
+                        help='number of slowest imports to show')
+    parser.add_argument('commands', nargs='*', default=sorted(COMMANDS))
+    args = parser.parse_args()
+
+    over_budget = False
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, 'storage'))
+        environment = dict(os.environ, XDG_CACHE_HOME=directory)
+        environment.pop('XDG_RUNTIME_DIR', None)
+
+        for name in args.commands:
+            walls = []
+            import_totals = []
+            for _ in range(args.runs):
+                wall, imports = run(COMMANDS[name], directory, environment)
+                walls.append(wall)
+                import_totals.append(
+                    sum(c for _, c in imports.values()) / 1000)
+
+            wall = statistics.median(walls)
+            import_time = statistics.median(import_totals)
+            wall_budget, import_budget = BUDGET[name]
+            failed = wall > wall_budget or import_time > import_budget
+            over_budget = over_budget or failed
+            print("%-6s wall %6.1f ms (budget %d)  imports %6.1f ms "
+                  "(budget %d)  %s" % (name, wall, wall_budget, import_time,
+                                      import_budget,
+                                      'OVER' if failed else 'ok'))
+            slowest = sorted(imports.items(), key=lambda i: -i[1][1])
+            for module, (_, cumulative) in slowest[:args.top]:
+                print("         %7.1f ms  %s" % (cumulative / 1000, module))
+
+    return 1 if over_budget else 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8
+""" Times password_store.py end to end and the functions behind it
+
+A synthetic store (see generate.py) is created in a temporary directory.
+list, get, show and create are run in a fresh interpreter each, then
+filter, _matching_keys, format_node and decrypt are timed in process.
+The medians are appended as one JSON line to a history file and compared
+with the last run that used the same parameters.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate
+
+ROOT = generate.ROOT
+SCRIPT = os.path.join(ROOT, 'password_store.py')
+
+# Helpers #####################################################################
+
+
+def measure(function, runs):
+    """ Calls function runs times, returns the median and minimum in ms """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': statistics.median(times), 'min_ms': min(times),
+            'runs': runs}
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=ROOT, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# End to end ##################################################################
+
+
+class Commands(object):
+    """ Runs password_store.py against the synthetic store """
+
+    def __init__(self, directory, store):
+        self.directory = directory
+        self.store = store
+        self.environment = dict(os.environ,
+                                XDG_CACHE_HOME=os.path.join(directory,
+                                                            'cache'))
+        self.environment.pop('XDG_RUNTIME_DIR', None)
+        if store['gnupg_home'] is not None:
+            self.environment['GNUPGHOME'] = store['gnupg_home']
+        self.created = 0
+
+    def run(self, *arguments, **kwargs):
+        command = [sys.executable, '-W', 'ignore', SCRIPT, '--no-daemon',
+                   '-c', os.path.join(self.directory, 'configuration'),
+                   '-d', self.store['storage']] + list(arguments)
+        process = subprocess.run(command, env=self.environment,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE,
+                                 universal_newlines=True, **kwargs)
+        if process.returncode != 0:
+            lines = process.stderr.strip().splitlines() or ['failed']
+            raise RuntimeError(lines[-1])
+
+    def create(self, backend):
+        self.created += 1
+        self.run('create', backend, 'benchmark/new%06d' % self.created,
+                 input="secret\n")
+
+    def benchmarks(self):
+        """ Yields (name, function) for every command to time """
+        keys = self.store['keys']
+        key = keys[len(keys) // 2]
+        # A pattern instead of the exact key, so the backends are searched
+        pattern = "%s$" % os.path.basename(key)
+        yield 'list', lambda: self.run('list')
+        yield 'get (search)', lambda: self.run('get', pattern)
+        for backend in self.store['backends']:
+            yield ('get %s' % backend,
+                   lambda b=backend: self.run('get', '%s/%s' % (b, key)))
+            yield ('show %s' % backend,
+                   lambda b=backend: self.run('show', '%s/%s' % (b, key)))
+            yield ('create %s' % backend,
+                   lambda b=backend: self.create(b))
+
+
+# Functions ###################################################################
+
+
+def function_benchmarks(directory, store):
+    """ Yields (name, function) for the functions to time in process """
+    os.environ['XDG_CACHE_HOME'] = os.path.join(directory, 'cache')
+    if store['gnupg_home'] is not None:
+        os.environ['GNUPGHOME'] = store['gnupg_home']
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from backends import get_backends
+    from display import Output
+    from matchers import RegexpMatcher
+
+    class RecordingOutput(Output):
+
+        def __init__(self):
+            super(RecordingOutput, self).__init__(stream=io.StringIO())
+            self.nodes = []
+
+        def format_node(self, node):
+            self.nodes.append(node)
+            return super(RecordingOutput, self).format_node(node)
+
+    backends = get_backends(store['storage'], reload=True)
+    no_match = RegexpMatcher('no such key')
+    for name in store['backends']:
+        backend = backends[name]
+        backend.index.update()
+        yield ('%s.filter' % name,
+               lambda b=backend: b.filter(Output(stream=io.StringIO())))
+        yield ('%s._matching_keys' % name,
+               lambda b=backend: list(b._matching_keys(no_match)))
+
+        recorder = RecordingOutput()
+        backend.filter(recorder)
+        output = Output(stream=io.StringIO())
+        yield ('%s.format_node' % name,
+               lambda nodes=recorder.nodes: [output.format_node(node)
+                                             for node in nodes])
+
+    if 'gpg' in backends:
+        backend = backends['gpg']
+        key = store['keys'][len(store['keys']) // 2]
+        with open(backend.path_for_key(key), 'rb') as entry:
+            encrypted = entry.read()
+        yield 'gpg.decrypt', lambda: backend.decrypt(encrypted)
+        yield 'gpg.password_for_key', lambda: backend.password_for_key(key)
+
+
+# Results #####################################################################
+
+
+def last_result(path, parameters):
+    """ Returns the last result in the history file with parameters """
+    last = None
+    try:
+        with open(path, 'r') as history:
+            for line in history:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('parameters') == parameters:
+                    last = record
+    except FileNotFoundError:
+        pass
+    return last
+
+
+def report(results, previous):
+    for name, result in results.items():
+        if 'error' in result:
+            print("%-28s error: %s" % (name, result['error']))
+            continue
+        line = "%-28s %9.2f ms (min %9.2f)" % (name, result['median_ms'],
+                                              result['min_ms'])
+        before = (previous or {}).get('results', {}).get(name, {})
+        if before.get('median_ms'):
+            change = result['median_ms'] / before['median_ms'] - 1
+            line += "  %+6.1f%% vs %s" % (change * 100,
+                                          previous.get('commit') or '?')
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--keys', type=int, default=1000,
+                        help='number of keys per backend')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='directories above every key')
+    parser.add_argument('--fanout', type=int, default=10,
+                        help='directories per level')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='runs of every command')
+    parser.add_argument('--function-runs', type=int, default=20,
+                        help='runs of every function')
+    parser.add_argument('--no-gpg', action='store_true',
+                        help='leave out the GPG backend')
+    parser.add_argument('-o', '--output',
+                        default=os.path.join(os.path.dirname(
+                            os.path.abspath(__file__)), 'results.jsonl'),
+                        help='history file the results are appended to')
+    args = parser.parse_args()
+
+    parameters = {'keys': args.keys, 'depth': args.depth,
+                  'fanout': args.fanout, 'gpg': not args.no_gpg}
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='pwbench') as directory:
+        store = generate.generate(directory, args.keys, args.depth,
+                                  args.fanout, gpg=not args.no_gpg)
+        try:
+            commands = Commands(directory, store)
+            benchmarks = [(name, function, args.runs)
+                          for name, function in commands.benchmarks()]
+            benchmarks.extend((name, function, args.function_runs)
+                              for name, function in
+                              function_benchmarks(directory, store))
+            for name, function, runs in benchmarks:
+                try:
+                    # The first run warms the caches and isn't counted
+                    function()
+                    results[name] = measure(function, runs)
+                except Exception as error:
+                    results[name] = {'error': str(error)}
+        finally:
+            if store['gnupg_home'] is not None:
+                generate.stop_agent(store['gnupg_home'])
+
+    record = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit(),
+        'python': platform.python_version(),
+        'parameters': parameters,
+        'results': results,
+    }
+    previous = last_result(args.output, parameters)
+    report(results, previous)
+    with open(args.output, 'a') as history:
+        history.write(json.dumps(record, sort_keys=True) + "\n")
+
+    return 1 if any('error' in result for result in results.values()) else 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
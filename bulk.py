@@ -0,0 +1,318 @@
+# -*- coding: UTF-8
+
+import base64
+import io
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+from backends import is_key_name, normalize_key, ordered
+from cache import Checkpoint, cache_path
+from walker import FILE, walk
+
+log = logging.getLogger(__name__)
+
+# Progress ####################################################################
+
+
+class Progress(object):
+    """ Counts processed entries and reports the rate on a stream """
+
+    def __init__(self, action, total=None, stream=None, interval=1.0):
+        self.action = action
+        self.total = total
+        self.stream = stream
+        self.interval = interval
+        self.count = 0
+        self.failures = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.reported = self.started
+
+    def update(self, size=0, failed=False):
+        if failed:
+            self.failures += 1
+        else:
+            self.count += 1
+        self.bytes += size
+        now = time.monotonic()
+        if self.stream is not None and now - self.reported >= self.interval:
+            self.reported = now
+            self.report()
+
+    def skip(self):
+        self.skipped += 1
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            'entries': self.count,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'bytes': self.bytes,
+            'seconds': elapsed,
+            'entries_per_second': self.count / elapsed if elapsed else 0.0,
+        }
+
+    def report(self, final=False):
+        stats = self.stats()
+        if self.total is None or final:
+            done = "%d" % self.count
+        else:
+            done = "%d/%d" % (self.count + self.failures + self.skipped,
+                              self.total)
+        skipped = ", %d skipped" % self.skipped if self.skipped else ""
+        self.stream.write("%s %s entries (%d failed%s, %d bytes) in %.1f s, "
+                          "%.1f entries/s%s" % (
+                              self.action, done, self.failures, skipped,
+                              self.bytes, stats['seconds'],
+                              stats['entries_per_second'],
+                              "\n" if final else "\r"))
+        self.stream.flush()
+
+    def finish(self):
+        if self.stream is not None:
+            self.report(final=True)
+        return self.stats()
+
+
+# Search ######################################################################
+
+
+def grep(backends, pattern, key_matcher=None, flags=0, workers=None,
+         names_only=False, stream=None):
+    """ Writes <storage>/<key>:<line number>:<line> for matching lines
+
+    Only the entries whose key matches key_matcher are read, encrypted
+    ones are decrypted by a bounded number of parallel workers and the
+    lines are written as the entries come in, not in key order. With
+    names_only just <storage>/<key> is written once per matching entry.
+    Returns the number of matching entries.
+    """
+    regexp = re.compile(pattern, flags)
+    stream = stream or sys.stdout
+    found = 0
+    for backend in ordered(backends):
+        keys = backend.keys(key_matcher)
+        for key, content in backend.read_entries(keys, workers):
+            if isinstance(content, Exception):
+                log.warning("Can't read %s/%s: %s", backend.name, key,
+                            content)
+                continue
+
+            text = content.decode('UTF-8', 'replace')
+            matched = False
+            for number, line in enumerate(text.splitlines(), 1):
+                if regexp.search(line) is None:
+                    continue
+                matched = True
+                if names_only:
+                    break
+                stream.write("%s/%s:%d:%s\n" % (backend.name, key, number,
+                                                line))
+            if matched:
+                found += 1
+                if names_only:
+                    stream.write("%s/%s\n" % (backend.name, key))
+                stream.flush()
+
+    return found
+
+
+# Export ######################################################################
+
+def export_record(storage, key, content):
+    """ Returns the JSONL line for an entry, binary content as base64 """
+    record = {'storage': storage, 'key': key}
+    try:
+        record['content'] = content.decode('UTF-8')
+    except UnicodeDecodeError:
+        record['content'] = base64.b64encode(content).decode('ascii')
+        record['encoding'] = 'base64'
+    return (json.dumps(record) + "\n").encode('UTF-8')
+
+
+def export(backends, key_matcher=None, output_format='jsonl', workers=None,
+           stream=None, progress_stream=None):
+    """ Writes every entry whose key matches key_matcher to stream
+
+    The keys are enumerated once, then the entries are read (decrypted in
+    parallel for GPG backends) and written one by one as JSON lines or as
+    members of a tar archive, so only the entries in flight are held in
+    memory. Returns the statistics of the run.
+    """
+    import tarfile
+
+    stream = stream or sys.stdout.buffer
+    selected = [(backend, list(backend.keys(key_matcher)))
+                for backend in ordered(backends)]
+    progress = Progress('Exported', sum(len(keys) for _, keys in selected),
+                        progress_stream)
+
+    archive = None
+    if 'tar' == output_format:
+        archive = tarfile.open(fileobj=stream, mode='w|')
+    try:
+        for backend, keys in selected:
+            for key, content in backend.read_entries(keys, workers):
+                if isinstance(content, Exception):
+                    log.warning("Can't export %s/%s: %s", backend.name, key,
+                                content)
+                    progress.update(failed=True)
+                    continue
+
+                if archive is None:
+                    stream.write(export_record(backend.name, key, content))
+                else:
+                    info = tarfile.TarInfo("%s/%s" % (backend.name, key))
+                    info.size = len(content)
+                    info.mode = 0o600
+                    info.mtime = time.time()
+                    archive.addfile(info, io.BytesIO(content))
+                progress.update(size=len(content))
+    finally:
+        if archive is not None:
+            archive.close()
+        stream.flush()
+
+    return progress.finish()
+
+
+# Import ######################################################################
+
+
+def import_source(source):
+    """ Yields (key, content) from a directory or a JSONL file
+
+    A directory is walked like a backend, every entry in it becomes the
+    key of its relative path. JSONL records are the ones written by
+    export, '-' reads them from stdin.
+    """
+    if os.path.isdir(source):
+        for event, path, name, _ in walk(source):
+            if FILE == event and is_key_name(name):
+                with open(os.path.join(source, path), 'rb') as entry:
+                    yield path, entry.read()
+        return
+
+    stream = sys.stdin.buffer if '-' == source else open(source, 'rb')
+    with stream:
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line.decode('UTF-8'))
+                content = record['content']
+                if 'base64' == record.get('encoding'):
+                    content = base64.b64decode(content)
+                else:
+                    content = content.encode('UTF-8')
+                yield record['key'], content
+            except (ValueError, KeyError, TypeError) as error:
+                log.error("Skipping line %d of %s: %s", number, source,
+                          error)
+
+
+def import_entries(backend, items, workers=None, overwrite=False,
+                   progress_stream=None):
+    """ Stores the (key, content) items in backend
+
+    Entries are encrypted by a pool of workers (for GPG backends) and each
+    one is written atomically, so an entry either exists complete or not
+    at all. Unless overwrite is set existing entries are skipped, running
+    an interrupted import again resumes it. Returns the statistics.
+    """
+    progress = Progress('Imported', None, progress_stream)
+    sizes = {}
+
+    def pending():
+        for key, content in items:
+            normalized = normalize_key(key)
+            if normalized is None:
+                log.error("Not a valid key: %s", key)
+                progress.update(failed=True)
+                continue
+            if not overwrite and backend.lookup(normalized) is not None:
+                progress.skip()
+                continue
+            sizes[normalized] = len(content)
+            yield normalized, content
+
+    for key, error in backend.write_entries(pending(), workers, overwrite):
+        size = sizes.pop(key, 0)
+        if error is None:
+            progress.update(size=size)
+        elif isinstance(error, FileExistsError):
+            progress.skip()
+        else:
+            log.warning("Can't import %s: %s", key, error)
+            progress.update(failed=True)
+
+    return progress.finish()
+
+
+# Re-encryption ###############################################################
+
+
+def reencrypt(backend, workers=None, dry_run=False, restart=False,
+              stream=None, progress_stream=None):
+    """ Re-encrypts the entries of a GPG backend to its configured keys
+
+    The recipients of every entry are read from its packet headers and
+    only entries encrypted to other keys are decrypted and re-encrypted,
+    in parallel, each one replaced atomically. Finished keys are recorded
+    in a checkpoint so an interrupted run resumes where it stopped, unless
+    restart is set. With dry_run the keys that need re-encryption are
+    written to stream instead. Returns the statistics of the run.
+    """
+    stream = stream or sys.stdout
+    with backend.gpg_pool(workers) as pool:
+        expected = pool.key_ids(backend.fingerprints())
+        checkpoint = Checkpoint(cache_path('reencrypt', backend.root),
+                                {'root': backend.root,
+                                 'recipients': sorted(expected)})
+        finished = set() if restart or dry_run else checkpoint.load()
+        keys = list(backend.keys())
+        progress = Progress('Would re-encrypt' if dry_run else 'Re-encrypted',
+                            len(keys), progress_stream)
+
+        def pending():
+            for key in keys:
+                if key in finished:
+                    progress.skip()
+                else:
+                    yield key, key
+
+        def reencrypt_entry(key):
+            return backend.reencrypt_entry(key, pool, expected, dry_run)
+
+        if not dry_run:
+            checkpoint.open(resume=bool(finished))
+        try:
+            for key, result in pool.run(reencrypt_entry, pending()):
+                if isinstance(result, Exception):
+                    log.warning("Can't re-encrypt %s/%s: %s", backend.name,
+                                key, result)
+                    progress.update(failed=True)
+                elif not result:
+                    if not dry_run:
+                        checkpoint.add(key)
+                    progress.skip()
+                elif dry_run:
+                    stream.write("%s/%s\n" % (backend.name, key))
+                    progress.update()
+                else:
+                    checkpoint.add(key, sync=True)
+                    progress.update()
+        finally:
+            checkpoint.close()
+        log.debug("Re-encryption: %s", pool.stats())
+
+    stats = progress.finish()
+    if not dry_run and not stats['failures']:
+        checkpoint.remove()
+    return stats
@@ -0,0 +1,591 @@
+# -*- coding: UTF-8
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import zlib
+
+import timings
+from walker import ENTER, FILE, LEAVE, list_directory, walk
+
+log = logging.getLogger(__name__)
+
+INDEX_VERSION = 3
+MANIFEST_VERSION = 1
+
+# Files and directories modified this close to the time they were scanned
+# get their mtime recorded as unknown, a change within the same timestamp
+# tick would otherwise go unnoticed on the next run.
+RACY_MTIME_WINDOW = 2.0
+
+# Helpers #####################################################################
+
+
+def cache_directory():
+    """ Returns (and creates) the directory where caches are stored """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    directory = os.path.join(base, 'pwstore')
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return directory
+
+
+def cache_path(kind, root, suffix='.json'):
+    """ Returns the cache file of the given kind for the directory root
+
+    The name only has to tell backends apart, the files record their root
+    so a checksum collision is caught when reading.
+    """
+    root = os.path.abspath(root)
+    checksum = zlib.crc32(root.encode('UTF-8'))
+    return os.path.join(cache_directory(), "%s-%s-%08x%s" % (
+        kind, os.path.basename(root), checksum, suffix))
+
+
+def stable_mtime(path):
+    """ Returns the mtime of path, None if it is too recent to rely on """
+    mtime = os.stat(path).st_mtime
+    if time.time() - mtime < RACY_MTIME_WINDOW:
+        return None
+    return mtime
+
+
+def read_json(path):
+    """ Returns the JSON data stored in path or None if it is unreadable """
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as error:
+        log.warning("Ignoring unreadable cache %s: %s", path, error)
+        return None
+
+
+def write_json(path, data):
+    """ Atomically replaces path with data serialized as JSON """
+    write_file(path, json.dumps(data, separators=(',', ':')).encode('UTF-8'))
+
+
+def write_file(path, data):
+    """ Atomically replaces path with data (bytes)
+
+    Every writer gets its own temporary file, so concurrent processes (or
+    threads) saving the same cache never mix their data, the last one to
+    finish wins.
+    """
+    descriptor, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.',
+        suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+# Key index ###################################################################
+
+
+class KeyIndex(object):
+    """ On-disk index of the directories and files in a backend
+
+    For every directory the index records its mtime together with the
+    names of its sub directories and files and the number of files in and
+    below it (the ones counted passes, all without). On update every
+    indexed directory is stat'ed and only the ones with a changed mtime
+    are listed again, the full tree is only walked when the index is
+    missing or corrupt. Only their counts and the ones above them change.
+    """
+
+    def __init__(self, root, path=None, counted=None):
+        self.root = os.path.abspath(root)
+        self.path = path
+        self.counted = counted
+        self.dirs = None
+        self.dirty = False
+        # Directories listed again, their counts are out of date
+        self._relisted = set()
+        # Set when entries were written, the next use checks for changes
+        self.stale = False
+        # Bumped whenever the indexed keys change, for derived indexes
+        self.generation = 0
+        self.log = logging.getLogger('cache.KeyIndex')
+
+    @property
+    def loaded(self):
+        return self.dirs is not None
+
+    def _absolute(self, relative):
+        if relative:
+            return os.path.join(self.root, relative)
+        return self.root
+
+    def _mtime(self, relative):
+        return stable_mtime(self._absolute(relative))
+
+    def _scan(self, relative):
+        """ Lists one directory and returns its index record """
+        try:
+            mtime = self._mtime(relative)
+            subs, files = list_directory(self._absolute(relative),
+                                         self.root)
+        except OSError:
+            return None
+
+        return [mtime, subs, files, None]
+
+    def _scan_tree(self, relative):
+        """ Scans relative and everything below it into the index """
+        try:
+            records = {relative: [self._mtime(relative), [], [], None]}
+        except OSError:
+            return
+        for event, path, name, _ in walk(self.root, relative):
+            if ENTER == event:
+                try:
+                    records[path] = [self._mtime(path), [], [], None]
+                except OSError:
+                    continue
+                records[os.path.dirname(path)][1].append(name)
+            elif FILE == event:
+                records[os.path.dirname(path)][2].append(name)
+
+        self.dirs.update(records)
+        self._relisted.update(records)
+        self.dirty = True
+
+    def _drop_tree(self, relative):
+        prefix = relative + os.sep
+        for name in [d for d in self.dirs
+                     if d == relative or d.startswith(prefix)]:
+            del self.dirs[name]
+        self._relisted.add(os.path.dirname(relative))
+        self.dirty = True
+
+    def load(self):
+        """ Reads the index from disk, returns False if it is unusable """
+        if self.path is None:
+            self.path = cache_path('index', self.root)
+        try:
+            with open(self.path, 'r') as index_file:
+                data = json.load(index_file)
+            if data.get('version') != INDEX_VERSION:
+                self.log.debug("Index format changed, rebuilding")
+                return False
+            if data.get('root') != self.root or '' not in data['dirs']:
+                raise ValueError("Index does not match backend")
+            self.dirs = data['dirs']
+            return True
+        except FileNotFoundError:
+            self.log.debug("No index for %s", self.root)
+        except (OSError, ValueError, KeyError, TypeError,
+                AttributeError) as error:
+            self.log.warning("Rebuilding corrupt index %s: %s",
+                             self.path, error)
+        self.dirs = None
+        return False
+
+    def save(self):
+        if self.path is None:
+            self.path = cache_path('index', self.root)
+        try:
+            write_json(self.path, {'version': INDEX_VERSION,
+                                   'root': self.root,
+                                   'dirs': self.dirs})
+            self.dirty = False
+        except OSError as error:
+            self.log.warning("Could not write index %s: %s", self.path, error)
+
+    def rebuild(self):
+        self.log.debug("Rebuilding index for %s", self.root)
+        self.dirs = {}
+        self._scan_tree('')
+
+    def refresh(self):
+        """ Re-lists every directory whose mtime changed """
+        timings.count('directories_checked', len(self.dirs))
+        for relative in sorted(self.dirs):
+            if relative not in self.dirs:
+                # Dropped together with a removed parent
+                continue
+            mtime, old_subs = self.dirs[relative][:2]
+            try:
+                current_mtime = os.stat(self._absolute(relative)).st_mtime
+            except OSError:
+                self._drop_tree(relative)
+                continue
+            if mtime is not None and mtime == current_mtime:
+                continue
+
+            record = self._scan(relative)
+            if record is None:
+                self._drop_tree(relative)
+                continue
+            self.dirs[relative] = record
+            self._relisted.add(relative)
+            self.dirty = True
+
+            new_subs = set(record[1])
+            for sub in set(old_subs) - new_subs:
+                self._drop_tree(os.path.join(relative, sub))
+            for sub in new_subs - set(old_subs):
+                self._scan_tree(os.path.join(relative, sub))
+
+        if '' not in self.dirs:
+            self.rebuild()
+
+    @timings.measured('index')
+    def update(self):
+        """ Brings the index up to date with the file system """
+        if self.dirs is None and not self.load():
+            self.rebuild()
+        else:
+            self.refresh()
+        self.stale = False
+
+        if self.dirty:
+            self._count()
+            self.generation += 1
+            self.save()
+
+    def _count(self):
+        """ Counts the files below the directories listed again since the
+        last update, and the directories above them
+        """
+        pending = set()
+        for relative in self._relisted:
+            while relative not in pending:
+                pending.add(relative)
+                if not relative:
+                    break
+                relative = os.path.dirname(relative)
+        self._relisted = set()
+
+        counted = self.counted
+        # A directory's path is always longer than its parent's
+        for relative in sorted(pending, key=len, reverse=True):
+            record = self.dirs.get(relative)
+            if record is None:
+                continue
+            _, subs, files, _ = record
+            total = len(files) if counted is None else \
+                sum(1 for name in files if counted(name))
+            for sub in subs:
+                below = self.dirs.get(os.path.join(relative, sub))
+                if below is not None:
+                    total += below[3] or 0
+            record[3] = total
+
+    def _entries(self, relative):
+        _, subs, files, _ = self.dirs[relative]
+        final = len(files) + len(subs) - 1
+        for position, name in enumerate(files):
+            yield FILE, os.path.join(relative, name), name, position == final
+        for position, name in enumerate(subs, len(files)):
+            yield ENTER, os.path.join(relative, name), name, position == final
+
+    def events(self):
+        """ Yields the same (event, path, name, last) tuples as walker.walk
+        """
+        if self.dirs is None or self.stale:
+            self.update()
+        if '' not in self.dirs:
+            return
+
+        stack = [('', self._entries(''), True)]
+        while stack:
+            relative, pending, last_dir = stack[-1]
+            item = next(pending, None)
+            if item is None:
+                stack.pop()
+                if stack:
+                    yield LEAVE, relative, os.path.basename(relative), last_dir
+                continue
+
+            event, path, name, last = item
+            if FILE == event:
+                yield item
+            elif path in self.dirs:
+                yield item
+                stack.append((path, self._entries(path), last))
+
+    def directories(self):
+        """ Yields (path, sub directories, files) for every directory """
+        if self.dirs is None or self.stale:
+            self.update()
+        for relative, (_, subs, files, _) in self.dirs.items():
+            yield relative, subs, files
+
+    def listing(self, relative):
+        """ Returns (sub directories, files, number of files in and below)
+        of a directory, None if it isn't indexed
+        """
+        if self.dirs is None or self.stale:
+            self.update()
+        record = self.dirs.get(relative)
+        return None if record is None else record[1:]
+
+    def stamps(self):
+        """ Returns {path: mtime} of the indexed directories
+
+        The keys are the same as long as none of the mtimes changed, an
+        mtime of None is unknown.
+        """
+        if self.dirs is None or self.stale:
+            self.update()
+        return {self._absolute(relative): record[0]
+                for relative, record in self.dirs.items()}
+
+    def keys(self):
+        """ Yields (path, name) for every file, relative to the root """
+        for event, path, name, _ in self.events():
+            if FILE == event:
+                yield path, name
+
+
+# Entry cache #################################################################
+
+
+def _zero(buffer):
+    buffer[:] = bytes(len(buffer))
+
+
+class EntryCache(object):
+    """ In-memory LRU cache of decrypted entries for long running processes
+
+    Entries are keyed by path and remembered together with the inode,
+    size and mtime of the file, a changed file is read again. Every entry
+    expires ttl seconds after it was read and the least recently used
+    ones are evicted to stay below max_bytes. The cache keeps its copies
+    in bytearrays that are overwritten with zeros when they are dropped,
+    copies handed out to callers are theirs to look after.
+    """
+
+    def __init__(self, max_bytes=1 << 20, ttl=300.0, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # path: (stamp, expires, content)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.log = logging.getLogger('cache.EntryCache')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, path):
+        _, _, content = self._entries.pop(path)
+        self.size -= len(content)
+        _zero(content)
+
+    def _expire(self, now):
+        expired = [path for path, (_, expires, _) in self._entries.items()
+                   if expires <= now]
+        for path in expired:
+            self._drop(path)
+
+    def get(self, path, stamp):
+        """ Returns the cached content for path if stamp still matches """
+        with self._lock:
+            item = self._entries.get(path)
+            if item is not None and \
+                    (item[0] != stamp or item[1] <= self.clock()):
+                self._drop(path)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(path)
+            return bytes(item[2])
+
+    def put(self, path, stamp, content):
+        """ Remembers content (bytes) for path, unless it is too large """
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            if path in self._entries:
+                self._drop(path)
+            now = self.clock()
+            self._expire(now)
+            while self._entries and self.size + len(content) > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+            self._entries[path] = (stamp, now + self.ttl, bytearray(content))
+            self.size += len(content)
+
+    def content(self, backend, key):
+        """ Returns the (decrypted) content of key in backend, as bytes """
+        path = backend.path_for_key(key)
+        stamp = backend.entry_stamp(key)
+        content = self.get(path, stamp)
+        if content is None:
+            content = backend.content_for_key(key)
+            self.put(path, stamp, content)
+        return content
+
+    def expire(self):
+        """ Drops the entries that have outlived their ttl """
+        with self._lock:
+            self._expire(self.clock())
+
+    def flush(self):
+        """ Drops every entry, returns how many there were """
+        with self._lock:
+            count = len(self._entries)
+            for path in list(self._entries):
+                self._drop(path)
+        self.log.debug("Flushed %d entries", count)
+        return count
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self.size,
+                'hits': self.hits, 'misses': self.misses}
+
+
+# Backend manifest ############################################################
+
+
+class BackendManifest(object):
+    """ Remembers the backends found below a storage directory
+
+    Besides the backends (path and parsed storage.conf) the manifest keeps
+    the mtime of every directory that was searched for them. It is
+    current as long as none of those directories or configuration files
+    changed, which takes one stat each instead of a walk.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.path = cache_path('manifest', self.directory)
+        self.log = logging.getLogger('cache.BackendManifest')
+
+    def load(self):
+        """ Returns the recorded backends, None if they may have changed """
+        data = read_json(self.path)
+        try:
+            if data is None or data['version'] != MANIFEST_VERSION or \
+                    data['root'] != self.directory:
+                return None
+            for path, mtime in data['dirs'].items():
+                if mtime is None or stable_mtime(path) != mtime:
+                    self.log.debug("%s changed", path)
+                    return None
+            for backend in data['backends']:
+                if backend['mtime'] is None or \
+                        stable_mtime(backend['config_file']) != \
+                        backend['mtime']:
+                    self.log.debug("%s changed", backend['config_file'])
+                    return None
+            return data['backends']
+        except OSError:
+            return None
+        except (KeyError, TypeError, AttributeError) as error:
+            self.log.warning("Ignoring corrupt manifest %s: %s",
+                             self.path, error)
+            return None
+
+    def stamps(self):
+        """ Returns {path: mtime} of what the backends were found from
+
+        These are the directories searched and the configuration files,
+        checked the same way by load.
+        """
+        data = read_json(self.path)
+        try:
+            stamps = dict(data['dirs'])
+            stamps.update((backend['config_file'], backend['mtime'])
+                          for backend in data['backends'])
+            return stamps
+        except (KeyError, TypeError, AttributeError, ValueError):
+            return {self.directory: None}
+
+    def save(self, dirs, backends):
+        """ Stores backends together with {directory: mtime} in dirs """
+        try:
+            write_json(self.path, {'version': MANIFEST_VERSION,
+                                   'root': self.directory,
+                                   'dirs': dirs,
+                                   'backends': backends})
+        except OSError as error:
+            self.log.warning("Could not write manifest %s: %s",
+                             self.path, error)
+
+
+# Checkpoint ##################################################################
+
+
+class Checkpoint(object):
+    """ Append-only record of the keys a resumable run has finished
+
+    The first line identifies the run (stamp), every following line is a
+    finished key, all as JSON. A checkpoint for another stamp, or a line
+    cut short by a crash, is ignored.
+    """
+
+    def __init__(self, path, stamp):
+        self.path = path
+        self.stamp = stamp
+        self.file = None
+        self.log = logging.getLogger('cache.Checkpoint')
+
+    def load(self):
+        """ Returns the set of finished keys """
+        keys = set()
+        try:
+            with open(self.path, 'r') as checkpoint_file:
+                if json.loads(checkpoint_file.readline()) != self.stamp:
+                    self.log.info("Ignoring checkpoint of another run")
+                    return keys
+                for line in checkpoint_file:
+                    try:
+                        keys.add(json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as error:
+            self.log.warning("Ignoring unreadable checkpoint %s: %s",
+                             self.path, error)
+            return set()
+        return keys
+
+    def open(self, resume=True):
+        """ Opens the checkpoint for adding keys, starts over unless resume
+        """
+        if resume and os.path.exists(self.path):
+            self.file = open(self.path, 'a')
+        else:
+            self.file = open(self.path, 'w')
+            self.file.write(json.dumps(self.stamp) + "\n")
+        return self
+
+    def add(self, key, sync=False):
+        """ Records key, with sync it is flushed to disk right away """
+        self.file.write(json.dumps(key) + "\n")
+        if sync:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
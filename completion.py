@@ -0,0 +1,211 @@
+# -*- coding: UTF-8
+
+import json
+import logging
+import os
+
+from cache import cache_path, stable_mtime, write_file
+
+log = logging.getLogger(__name__)
+
+KEY_LIST_VERSION = 1
+
+# A daemon that doesn't answer this fast is skipped, TAB shouldn't hang
+DAEMON_TIMEOUT = 1.0
+
+DEFAULT_DIRECTORY = '~/.pwstore/storage'
+
+# Helpers #####################################################################
+
+
+def _lower_bound(lines, value, low=0):
+    """ Returns the offset of the first line not less than value
+
+    lines are sorted and newline terminated (bytes), low is the offset
+    of a line to start the binary search at.
+    """
+    high = len(lines)
+    while low < high:
+        middle = (low + high) // 2
+        start = lines.rfind(b'\n', low, middle) + 1 or low
+        end = lines.find(b'\n', start)
+        if lines[start:end] < value:
+            low = end + 1
+        else:
+            high = start
+    return low
+
+
+def complete(lines, prefix):
+    """ Returns the entries in lines (sorted) starting with prefix
+
+    Like file names only the next path component is completed, all the
+    entries below a directory are returned as the directory with a
+    trailing slash. That takes one binary search per result, the lines
+    are neither scanned nor split.
+    """
+    prefix = prefix.encode('UTF-8')
+    completions = []
+    position = _lower_bound(lines, prefix)
+    while position < len(lines):
+        end = lines.find(b'\n', position)
+        entry = lines[position:end]
+        if not entry.startswith(prefix):
+            break
+        slash = entry.find(b'/', len(prefix))
+        if slash < 0:
+            completions.append(entry.decode('UTF-8'))
+            position = end + 1
+        else:
+            completions.append(entry[:slash + 1].decode('UTF-8'))
+            # '0' is the character after '/', it skips the directory
+            position = _lower_bound(lines, entry[:slash] + b'0', end + 1)
+    return completions
+
+
+def key_lines(backends):
+    """ Returns <storage>/<key> of all the keys in backends as sorted,
+    newline terminated lines (bytes)
+    """
+    entries = sorted("%s/%s" % (name, key)
+                     for name, backend in backends.items()
+                     for key in backend.keys())
+    return "".join(entry + "\n" for entry in entries).encode('UTF-8')
+
+
+def _current(stamps):
+    for path, mtime in stamps.items():
+        try:
+            if mtime is None or stable_mtime(path) != mtime:
+                log.debug("%s changed", path)
+                return False
+        except OSError:
+            return False
+    return True
+
+
+# Key list ####################################################################
+
+
+class KeyList(object):
+    """ The keys of a storage directory for completion
+
+    The sorted <storage>/<key> lines are cached in a file together with
+    the mtimes of what they were read from: the directories searched for
+    backends, their configuration files and the directories in the key
+    indexes (or the packs). While none of those changed the file is
+    current, so completing takes a stat per directory and a read instead
+    of loading the backends.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.path = cache_path('keys', self.directory, suffix='.txt')
+        self.storages = []
+        self.lines = b''
+        self.log = logging.getLogger('completion.KeyList')
+
+    def load(self):
+        """ Reads the lines, returns False if they may have changed """
+        try:
+            with open(self.path, 'rb') as key_file:
+                header = json.loads(key_file.readline().decode('UTF-8'))
+                if header['version'] != KEY_LIST_VERSION or \
+                        header['root'] != self.directory or \
+                        not _current(header['stamps']):
+                    return False
+                self.storages = header['storages']
+                self.lines = key_file.read()
+            return True
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError,
+                AttributeError) as error:
+            self.log.warning("Ignoring corrupt key list %s: %s",
+                             self.path, error)
+            return False
+
+    def rebuild(self):
+        """ Reads the keys from the backends and saves them """
+        from backends import get_backends
+        from cache import BackendManifest
+
+        self.log.debug("Rebuilding key list for %s", self.directory)
+        backends = get_backends(self.directory)
+        stamps = BackendManifest(self.directory).stamps()
+        for backend in backends.values():
+            stamps.update(backend.index.stamps())
+        self.storages = sorted(backends)
+        self.lines = key_lines(backends)
+
+        header = {'version': KEY_LIST_VERSION, 'root': self.directory,
+                  'storages': self.storages, 'stamps': stamps}
+        try:
+            write_file(self.path, json.dumps(header).encode('UTF-8') +
+                       b"\n" + self.lines)
+        except OSError as error:
+            self.log.warning("Could not write key list %s: %s",
+                             self.path, error)
+
+
+# Completion ##################################################################
+
+
+def completions(directory, prefix, storages=False, socket=None,
+                use_daemon=True):
+    """ Returns the <storage>/<key> entries (or storages) for prefix
+
+    A running daemon answers from the keys it has in memory, otherwise
+    the key list is used and only rebuilt when the store changed.
+    """
+    directory = os.path.abspath(os.path.expanduser(directory))
+    if use_daemon:
+        import daemon
+        message = {'command': 'complete', 'directory': directory,
+                   'prefix': prefix, 'storages': storages}
+        try:
+            response = daemon.request(socket or daemon.socket_path(),
+                                      message, timeout=DAEMON_TIMEOUT)
+        except OSError as error:
+            log.debug("Daemon failed to complete: %s", error)
+            response = None
+        if response is not None and 'ok' == response['status']:
+            return response['output']
+
+    key_list = KeyList(directory)
+    if not key_list.load():
+        key_list.rebuild()
+    if storages:
+        return [name for name in key_list.storages if name.startswith(prefix)]
+    return complete(key_list.lines, prefix)
+
+
+class KeyCompleter(object):
+    """ argcomplete completer for <storage>/<key> patterns
+
+    With storages the storage names are completed instead, with
+    storage_argument the keys of the storage given in that argument.
+    """
+
+    def __init__(self, storages=False, storage_argument=None):
+        self.storages = storages
+        self.storage_argument = storage_argument
+
+    def __call__(self, prefix, parsed_args, **kwargs):
+        directory = getattr(parsed_args, 'directory', None) or \
+            DEFAULT_DIRECTORY
+        options = {'socket': getattr(parsed_args, 'socket', None),
+                   'use_daemon': not getattr(parsed_args, 'no_daemon',
+                                             False)}
+        if self.storages:
+            return completions(directory, prefix, storages=True, **options)
+
+        if self.storage_argument is None:
+            return completions(directory, prefix, **options)
+
+        storage = getattr(parsed_args, self.storage_argument, None)
+        if not storage:
+            return []
+        start = len(storage) + 1
+        return [entry[start:] for entry in
+                completions(directory, storage + '/' + prefix, **options)]
@@ -0,0 +1,146 @@
+# -*- coding: UTF-8
+
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+
+import timings
+from cache import cache_directory
+
+log = logging.getLogger(__name__)
+
+SOCKET_NAME = "daemon.sock"
+# A daemon busy with a slow request (gpg asking for a passphrase) must not
+# keep clients from doing the work themselves for long
+CLIENT_TIMEOUT = 5.0
+
+# Helpers #####################################################################
+
+
+def socket_path():
+    """ Returns the default path of the daemon socket """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        directory = os.path.join(runtime, 'pwstore')
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    else:
+        directory = cache_directory()
+    return os.path.join(directory, SOCKET_NAME)
+
+
+def send(stream, message):
+    stream.write(json.dumps(message).encode('UTF-8') + b'\n')
+    stream.flush()
+
+
+def receive(stream):
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('UTF-8'))
+
+
+# Client ######################################################################
+
+
+@timings.measured('daemon')
+def request(path, message, timeout=CLIENT_TIMEOUT):
+    """ Sends message to the daemon at path and returns its response
+
+    Returns None when no daemon is listening, it doesn't answer in time
+    or the answer is garbled, so the caller can fall back to doing the
+    work itself.
+    """
+    if not os.path.exists(path):
+        return None
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        with client.makefile('rwb') as stream:
+            send(stream, message)
+            return receive(stream)
+    except (ConnectionRefusedError, FileNotFoundError):
+        log.debug("No daemon listening on %s", path)
+        return None
+    except (OSError, ValueError) as error:
+        log.debug("No answer from the daemon on %s: %s", path, error)
+        return None
+    finally:
+        client.close()
+
+
+# Server ######################################################################
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            message = receive(self.rfile)
+        except ValueError as error:
+            send(self.wfile, {'status': 'error', 'message': str(error)})
+            return
+        if message is None:
+            return
+
+        try:
+            output = self.server.dispatch(message)
+            response = {'status': 'ok', 'output': output}
+        except ValueError as error:
+            log.debug("Refused request: %s", error)
+            response = {'status': 'error', 'message': str(error)}
+        except Exception as error:
+            log.exception("Request %s failed", message.get('command'))
+            response = {'status': 'error', 'message': str(error)}
+        send(self.wfile, response)
+
+
+class Daemon(socketserver.UnixStreamServer):
+    """ Serves requests from a single thread on a unix socket
+
+    dispatch is called with every decoded request and returns the text to
+    send back to the client, idle (if given) about twice a second between
+    requests. The socket is only accessible by the user running the
+    daemon.
+    """
+
+    def __init__(self, path, dispatch, idle=None):
+        self.dispatch = dispatch
+        self.idle = idle
+        if request(path, {'command': 'ping'}, timeout=1.0) is not None:
+            raise RuntimeError("A daemon is already listening on %s" % path)
+        if os.path.exists(path):
+            os.unlink(path)
+
+        old_umask = os.umask(0o077)
+        try:
+            super(Daemon, self).__init__(path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def service_actions(self):
+        if self.idle is not None:
+            self.idle()
+
+    def server_close(self):
+        super(Daemon, self).server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+    def serve(self):
+        log.info("Listening on %s", self.server_address)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            log.info("Shutting down")
+        finally:
+            self.server_close()
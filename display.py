@@ -1,8 +1,12 @@
+import json
 import os
-from collections import defaultdict
+from collections import defaultdict, deque
+import sys
 
 import logging
 
+import timings
+
 log = logging.getLogger(__name__)
 
 
@@ -26,6 +30,27 @@ class Colorizer(object):
         return self.colorize(string, self.RED)
 
 
+class KeyWriter(object):
+    """ Writes one record per key, for other programs to read
+
+    plain and null write <storage>/<key> terminated by a newline or a NUL
+    character, jsonl writes a JSON object with storage and key per line.
+    """
+
+    def __init__(self, output_format='plain', stream=None):
+        self.format = output_format
+        self.stream = stream
+
+    def key(self, storage, key):
+        if 'jsonl' == self.format:
+            record = json.dumps({'storage': storage, 'key': key}) + "\n"
+        elif 'null' == self.format:
+            record = storage + "/" + key + "\0"
+        else:
+            record = storage + "/" + key + "\n"
+        (self.stream or sys.stdout).write(record)
+
+
 def tree_from_list(keys):
     treenode = None
     treenode = lambda: defaultdict(treenode)
@@ -49,127 +74,156 @@ def display(keys):
     print("\n".join(sorted(keys)))
 
 
-class Node:
+class Node(object):
+    """ An entry waiting to be printed
+
+    Whether a node is the last child of its parent decides both its own
+    connector and the padding of everything below it, so its line is held
+    back until that is known, unless last already tells it is. count is
+    the number of keys below, if shown.
+    """
+    __slots__ = ('name', 'parent', 'count', 'is_last', 'printed', 'written',
+                 'last_child')
     alias = 'N'
 
-    def __init__(self, name):
+    def __init__(self, name, parent=None, count=None, last=False):
         self.name = name
-        self.sub_tree = []
-
-    def __iter__(self):
-        return iter(self.sub_tree)
-
-    def __len__(self):
-        return len(self.sub_tree)
-
-    def __getitem__(self, key):
-        return self.sub_tree[key]
-
-    def __delitem__(self, key):
-        del self.sub_tree[key]
-
-    def append(self, node):
-        return self.sub_tree.append(node)
-
-    def remove(self, value):
-        return self.sub_tree.remove(value)
+        self.parent = parent
+        self.count = count
+        # Without last a sibling may still follow, or may all be left out
+        self.is_last = True if last else None
+        self.printed = False
+        self.written = False
+        self.last_child = None
 
     def __repr__(self):
-        return str((self.alias, self.name, self.sub_tree))
+        return str((self.alias, self.name))
 
 
 class Backend(Node):
+    __slots__ = ()
     alias = 'B'
 
 
 class Directory(Node):
+    __slots__ = ()
     alias = 'D'
 
 
 class Key(Node):
+    __slots__ = ()
     alias = 'K'
 
 
 class Output:
+    """ Renders the keys of the backends as trees while they are walked
+
+    Directories are only printed once a key below them is, so empty ones
+    never show up. A line is written as soon as it is known whether its
+    node is the last of its siblings, right away when it is passed as the
+    last one. Otherwise at most lookahead lines are held back, past that
+    the oldest is written as if more siblings follow.
+    """
     empty_pad = "    "
     line_pad = "\u2502   "
     tree_node = "\u251C\u2500\u2500 "
     tree_end = "\u2514\u2500\u2500 "
 
-    def __init__(self, colorizer=Colorizer()):
-        self.level = 0
-        self.stack = []
-        self.tree = Node('root')
-        self.current_node = self.tree
+    lookahead = 1024
+
+    def __init__(self, colorizer=Colorizer(), stream=None):
+        self.current_node = None
+        self.pending = deque()
+        self.stream = stream
 
         self.color = colorizer
 
-    def pad(self, line):
-        print(self.line_pad * self.level + line)
+    def write(self, line):
+        print(line, file=self.stream or sys.stdout)
 
-    def start_backend(self, name):
-        node = Backend(name)
-        self.current_node.append(node)
-        self.stack.append(self.current_node)
-        self.current_node = node
+    def start_backend(self, name, count=None):
+        self.current_node = Backend(name, count=count)
 
     def end_backend(self):
-        # self.level -= 1
-        previous_node = self.stack.pop()
-        if len(self.current_node) == 0:
-            previous_node.remove(self.current_node)
-        self.current_node = previous_node
-
-        while len(self.stack) > 0:
-            self.current_node = self.stack.pop()
+        self._end_node()
+        self._flush(everything=True)
+        self.current_node = None
 
-    def start_sub(self, name):
-        node = Directory(name)
-        self.current_node.append(node)
-        self.stack.append(self.current_node)
-        self.current_node = node
+    def start_sub(self, name, count=None, last=False):
+        self.current_node = Directory(name, self.current_node, count, last)
 
     def end_sub(self):
-        previous_node = self.stack.pop()
-        if len(self.current_node) == 0:
-            previous_node.remove(self.current_node)
-        self.current_node = previous_node
-
-    def key(self, key):
-        self.current_node.append(Key(key))
-
-    def pprint(self):
-        from pprint import pprint
-        pprint(self.tree)
-
-    def format_node(self, node, pad_string="", is_last=False):
-        result = []
-
-        if is_last:
-            sub_pad = self.empty_pad
-            this_pad = self.tree_end
+        self._end_node()
+        self.current_node = self.current_node.parent
+
+    def key(self, key, last=False):
+        self._print(Key(key, self.current_node, last=last))
+
+    def directory(self, name, count=None, last=False):
+        """ Prints a directory that is not expanded """
+        self._print(Directory(name, self.current_node, count, last))
+
+    def show(self):
+        """ Prints the current backend or directory, even with nothing below
+        """
+        if not self.current_node.printed:
+            self._print(self.current_node)
+
+    def _end_node(self):
+        last_child = self.current_node.last_child
+        if last_child is not None and not last_child.written:
+            last_child.is_last = True
+        self._flush()
+
+    def _print(self, node):
+        parent = node.parent
+        if parent is not None:
+            if not parent.printed:
+                self._print(parent)
+            previous = parent.last_child
+            if previous is not None and not previous.written:
+                previous.is_last = False
+            parent.last_child = node
         else:
-            sub_pad = self.line_pad
-            this_pad = self.tree_node
-
+            node.is_last = True
+
+        node.printed = True
+        self.pending.append(node)
+        self._flush()
+
+    @timings.measured('render')
+    def _flush(self, everything=False):
+        pending = self.pending
+        while pending:
+            node = pending[0]
+            if node.is_last is None:
+                if not everything and len(pending) <= self.lookahead:
+                    break
+                node.is_last = False
+            pending.popleft()
+            node.written = True
+            self.write(self.format_node(node))
+
+    def format_node(self, node):
+        """ Returns the line for node, it and its parents must be decided """
+        count = "" if node.count is None else " (%d)" % node.count
         if type(node) == Backend:
-            result.insert(0, pad_string + self.color.storage(node.name))
-            sub_pad = ""
-        elif type(node) == Directory:
-            result.insert(
-                0, pad_string + this_pad + self.color.directory(node.name))
-        elif type(node) == Key:
-            result.insert(0, pad_string + this_pad + node.name)
-
-        if type(node) != Key:
-            if len(node) > 0:
-                for n in node[:-1]:
-                    result.extend(self.format_node(n, pad_string + sub_pad))
-                n = node[-1]
-                result.extend(self.format_node(n, pad_string + sub_pad, True))
-
-        return result
+            return self.color.storage(node.name) + count
+
+        pads = []
+        parent = node.parent
+        while type(parent) == Directory:
+            pads.append(self.empty_pad if parent.is_last else self.line_pad)
+            parent = parent.parent
+        pads.reverse()
+
+        this_pad = self.tree_end if node.is_last else self.tree_node
+        if type(node) == Directory:
+            name = self.color.directory(node.name)
+        else:
+            name = node.name
+        return "".join(pads) + this_pad + name + count
 
     def pretty_print(self):
-        for node in self.tree:
-            print("\n".join(self.format_node(node)))
+        """ Writes what is still held back """
+        self._flush(everything=True)
@@ -0,0 +1,21 @@
+# -*- coding: UTF-8
+""" Exceptions raised by the gpg helpers
+
+Kept apart from gpgpool so catching them costs no imports.
+"""
+
+
+class GPGError(Exception):
+    pass
+
+
+class DecryptionError(GPGError):
+    pass
+
+
+class EncryptionError(GPGError):
+    pass
+
+
+class PacketError(GPGError):
+    pass
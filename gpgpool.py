@@ -0,0 +1,522 @@
+# -*- coding: UTF-8
+
+import base64
+import binascii
+import contextlib
+import io
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+
+import timings
+from errors import DecryptionError, EncryptionError, GPGError, \
+    PacketError
+
+log = logging.getLogger(__name__)
+
+
+# Packets #####################################################################
+
+# OpenPGP packet tags
+PKESK_TAG = 1
+MARKER_TAG = 10
+ENCRYPTED_DATA_TAGS = (9, 18, 20)
+
+# Validity of revoked, expired, invalid and disabled keys in gpg listings
+UNUSABLE_VALIDITY = ('r', 'e', 'i', 'd')
+
+# Key id of a hidden (or unknown) recipient
+HIDDEN_KEY_ID = '0' * 16
+
+# Entries up to this size (encrypted) are always decrypted to the end, so
+# gpg checks their integrity, even when only their first line is read
+EARLY_STOP_SIZE = 1 << 20
+
+# Keeps a curses pinentry from taking over the terminal of the caller
+PINENTRY_USER_DATA = "USE_CURSES=0"
+
+
+def _armored_chunks(stream):
+    """ Yields the decoded lines of an ASCII armored message """
+    # The rest of the BEGIN line and the armor headers end at a blank line
+    for line in stream:
+        if not line.strip():
+            break
+    for line in stream:
+        line = line.strip()
+        if not line or line.startswith(b'=') or line.startswith(b'-'):
+            return
+        try:
+            yield base64.b64decode(line)
+        except binascii.Error as error:
+            raise PacketError("Broken armor: %s" % error)
+
+
+def _chunks(stream):
+    head = stream.read(1)
+    if b'-' == head:
+        yield from _armored_chunks(stream)
+        return
+    yield head
+    while True:
+        chunk = stream.read(4096)
+        if not chunk:
+            return
+        yield chunk
+
+
+class _PacketReader(object):
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = bytearray()
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                raise PacketError("Truncated message")
+            self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def number(self, size):
+        return int.from_bytes(self.read(size), 'big')
+
+
+def recipient_key_ids(stream):
+    """ Returns the ids of the keys an encrypted message is encrypted to
+
+    Only the packets in front of the encrypted data are read from the
+    (binary or armored) stream, nothing is decrypted. Raises PacketError
+    for anything but a public key encrypted message.
+    """
+    reader = _PacketReader(_chunks(stream))
+    key_ids = []
+    while True:
+        header = reader.number(1)
+        if not header & 0x80:
+            raise PacketError("Not an OpenPGP message")
+
+        if header & 0x40:
+            tag = header & 0x3f
+            if tag in ENCRYPTED_DATA_TAGS:
+                return key_ids
+            first = reader.number(1)
+            if first < 192:
+                length = first
+            elif first < 224:
+                length = ((first - 192) << 8) + reader.number(1) + 192
+            elif 255 == first:
+                length = reader.number(4)
+            else:
+                raise PacketError("Unexpected partial length")
+        else:
+            tag = (header >> 2) & 0x0f
+            if tag in ENCRYPTED_DATA_TAGS:
+                return key_ids
+            if 3 == header & 0x03:
+                raise PacketError("Unexpected indeterminate length")
+            length = reader.number((1, 2, 4)[header & 0x03])
+
+        body = reader.read(length)
+        if PKESK_TAG == tag:
+            if body[:1] == b'\x03':
+                key_ids.append(body[1:9].hex().upper())
+            else:
+                key_ids.append(HIDDEN_KEY_ID)
+        elif MARKER_TAG != tag:
+            raise PacketError("Not an encrypted message")
+
+
+def matches_recipients(key_ids, expected):
+    """ Returns True if key_ids are exactly the keys of the recipients
+
+    expected maps every recipient to the ids of its encryption keys, the
+    message must be encrypted to one of them for each recipient and to
+    no other key.
+    """
+    found = set(key_ids)
+    known = set()
+    for ids in expected.values():
+        if found.isdisjoint(ids):
+            return False
+        known.update(ids)
+    return found <= known
+
+
+# Streams #####################################################################
+
+
+class _ProcessOutput(io.RawIOBase):
+    """ Unbuffered reader of a pipe that notes when the end was reached """
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.count = 0
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.pipe.readinto(buffer)
+        if not size:
+            self.eof = True
+        self.count += size or 0
+        return size
+
+    def close(self):
+        self.pipe.close()
+        super(_ProcessOutput, self).close()
+
+
+# Processes ###################################################################
+
+
+def gpg_environment(gnupg_home=None):
+    """ Returns the environment for gpg processes, os.environ is untouched
+    """
+    env = dict(os.environ)
+    env['PINENTRY_USER_DATA'] = PINENTRY_USER_DATA
+    if gnupg_home is not None:
+        env['GNUPGHOME'] = gnupg_home
+    return env
+
+
+def gnupg_directory(gnupg_home=None):
+    """ Returns the keyring directory gpg uses with gnupg_home """
+    if gnupg_home is None:
+        gnupg_home = os.environ.get('GNUPGHOME', '~/.gnupg')
+    return os.path.abspath(os.path.expanduser(gnupg_home))
+
+
+def gpg_command(gpg_binary, *arguments):
+    return [gpg_binary, '--batch', '--quiet', '--yes', '--no-tty'] + \
+        list(arguments)
+
+
+def encrypt_arguments(recipients):
+    arguments = ['--armor', '--trust-model', 'always', '--encrypt']
+    for recipient in recipients:
+        arguments.extend(['--recipient', recipient])
+    return arguments
+
+
+def list_keys_command(gpg_binary):
+    return gpg_command(gpg_binary, '--with-colons', '--list-keys')
+
+
+def parse_recipients(output, uids):
+    """ Returns {uid: fingerprint} for the uids in a --with-colons key
+    listing (bytes)
+    """
+    recipients = {}
+    fingerprint = None
+    for line in output.decode('UTF-8', 'replace').splitlines():
+        fields = line.split(':')
+        if 'pub' == fields[0]:
+            fingerprint = None
+        elif 'fpr' == fields[0] and fingerprint is None:
+            # The first fingerprint after pub is the one of the primary key
+            fingerprint = fields[9]
+        elif 'uid' == fields[0]:
+            uid = re.sub(r'\\x([0-9a-fA-F]{2})',
+                         lambda match: chr(int(match.group(1), 16)),
+                         fields[9])
+            if uid in uids and fingerprint is not None:
+                recipients[uid] = fingerprint
+    return recipients
+
+
+def gpg_failure(error_class, stderr):
+    return error_class(stderr.decode('UTF-8', 'replace').strip() or
+                       "gpg failed")
+
+
+# Pool ########################################################################
+
+
+class GPGPool(object):
+    """ Bounded pool of gpg workers for decrypting or encrypting many entries
+
+    gpg has no mode where one process handles a stream of separate
+    messages, so every request is still a gpg process. The pool keeps a
+    fixed number of worker threads feeding gpg in parallel (the agent
+    holds the unlocked secret keys, so the processes do not ask for
+    passphrases) and counts what passes through it.
+    """
+
+    def __init__(self, gpg_binary="gpg", workers=None, gnupg_home=None):
+        self.gpg_binary = gpg_binary
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self.env = gpg_environment(gnupg_home)
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self.started = None
+        self.counters = {
+            'requests': 0,
+            'failures': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'gpg_seconds': 0.0,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='gpg')
+            self.started = time.monotonic()
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self.counters[name] += value
+
+    def command(self, *arguments):
+        return gpg_command(self.gpg_binary, *arguments)
+
+    def _run(self, command, data, size, error_class):
+        start = time.monotonic()
+        process = subprocess.run(command, input=data,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, env=self.env)
+        seconds = time.monotonic() - start
+        self._count(requests=1, bytes_in=size,
+                    bytes_out=len(process.stdout), gpg_seconds=seconds)
+        timings.add_time('gpg', seconds)
+        timings.count('gpg_invocations')
+
+        if process.returncode != 0:
+            raise gpg_failure(error_class, process.stderr)
+        return process.stdout
+
+    def decrypt(self, data=None, path=None):
+        """ Decrypts data (bytes) or the file at path, returns bytes """
+        if data is None:
+            return self._run(self.command('--decrypt', path), None,
+                             os.path.getsize(path), DecryptionError)
+        return self._run(self.command('--decrypt'), data, len(data),
+                         DecryptionError)
+
+    @contextlib.contextmanager
+    def decrypt_reader(self, path):
+        """ Yields a binary file object reading the plaintext of path
+
+        gpg writes into the pipe behind the reader as it decrypts, nothing
+        is held in memory. Leaving the context before the end reads the
+        rest, so gpg checks the integrity and its errors (a manipulated
+        message among them) are raised. Only entries larger than
+        EARLY_STOP_SIZE stop gpg instead, then reading the first line
+        doesn't decrypt all of it but gpg never gets to check it either,
+        unless it already failed on its own.
+        """
+        start = time.monotonic()
+        size = os.path.getsize(path)
+        process = subprocess.Popen(self.command('--decrypt', path),
+                                   bufsize=0, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, env=self.env)
+        output = _ProcessOutput(process.stdout)
+        killed = False
+        try:
+            yield io.BufferedReader(output)
+            if size <= EARLY_STOP_SIZE:
+                while output.read(io.DEFAULT_BUFFER_SIZE):
+                    pass
+        finally:
+            output.close()
+            if not output.eof and process.poll() is None:
+                process.kill()
+                killed = True
+            error = process.stderr.read()
+            process.stderr.close()
+            returncode = process.wait()
+            seconds = time.monotonic() - start
+            self._count(requests=1, bytes_in=size, bytes_out=output.count,
+                        gpg_seconds=seconds)
+            timings.add_time('gpg', seconds)
+            timings.count('gpg_invocations')
+
+        if not killed and returncode != 0:
+            self._count(failures=1)
+            raise gpg_failure(DecryptionError, error)
+
+    def encrypt(self, data, recipients):
+        """ Encrypts data (bytes) to the recipients, returns armored bytes
+        """
+        return self._run(self.command(*encrypt_arguments(recipients)), data,
+                         len(data), EncryptionError)
+
+    def recipients(self, uids):
+        """ Returns {uid: fingerprint} for the uids found in the keyring """
+        output = self._run(list_keys_command(self.gpg_binary), None, 0,
+                           EncryptionError)
+        return parse_recipients(output, uids)
+
+    def key_ids(self, fingerprints):
+        """ Returns {fingerprint: ids of its usable encryption keys} """
+        output = self._run(self.command('--with-colons', '--list-keys',
+                                        '--', *fingerprints),
+                           None, 0, EncryptionError)
+        key_ids = {}
+        current = None
+        for line in output.decode('UTF-8', 'replace').splitlines():
+            fields = line.split(':')
+            if fields[0] in ('pub', 'sub'):
+                if 'pub' == fields[0]:
+                    current = set()
+                    # The fingerprint of the primary key follows
+                    key_ids[None] = current
+                if 'e' in fields[11] and fields[1] not in UNUSABLE_VALIDITY:
+                    current.add(fields[4])
+            elif 'fpr' == fields[0] and None in key_ids:
+                key_ids[fields[9]] = key_ids.pop(None)
+
+        result = {}
+        for fingerprint in fingerprints:
+            if not key_ids.get(fingerprint):
+                raise EncryptionError("No usable encryption key for %s" %
+                                      fingerprint)
+            result[fingerprint] = key_ids[fingerprint]
+        return result
+
+    def submit(self, function, *args, **kwargs):
+        return self.executor.submit(function, *args, **kwargs)
+
+    def run(self, function, items):
+        """ Calls function(argument) for (tag, argument) pairs on the pool
+
+        Yields (tag, result) as the calls complete, the result is the
+        exception instead when gpg or the file system failed. At most two
+        calls per worker are in flight, so memory stays bounded however
+        many items are given.
+        """
+        from concurrent.futures import FIRST_COMPLETED, wait
+
+        pending = {}
+        items = iter(items)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < 2 * self.workers:
+                try:
+                    tag, argument = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[self.submit(function, argument)] = tag
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                tag = pending.pop(future)
+                try:
+                    result = future.result()
+                except (GPGError, OSError) as error:
+                    self._count(failures=1)
+                    result = error
+                yield tag, result
+
+    def decrypt_files(self, items):
+        """ Decrypts (tag, path) pairs and yields (tag, data or error) """
+        return self.run(lambda path: self.decrypt(path=path), items)
+
+    def stats(self):
+        """ Returns the counters together with throughput figures """
+        with self._lock:
+            stats = dict(self.counters)
+        elapsed = 0.0
+        if self.started is not None:
+            elapsed = time.monotonic() - self.started
+        stats['workers'] = self.workers
+        stats['elapsed'] = elapsed
+        if elapsed > 0:
+            stats['requests_per_second'] = stats['requests'] / elapsed
+            stats['bytes_per_second'] = stats['bytes_out'] / elapsed
+        return stats
+
+
+class AsyncGPG(object):
+    """ Runs gpg as asyncio subprocesses, at most limit at a time
+
+    The counterpart of GPGPool for event loops: callers await the result
+    while gpg runs, no thread is tied up. Like GPGPool every request is a
+    gpg process with its own copy of the environment.
+    """
+
+    def __init__(self, gpg_binary="gpg", limit=None, gnupg_home=None):
+        self.gpg_binary = gpg_binary
+        self.limit = limit or min(8, os.cpu_count() or 1)
+        self.env = gpg_environment(gnupg_home)
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # Created on first use, inside the event loop
+        if self._semaphore is None:
+            import asyncio
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    async def _run(self, command, data, error_class):
+        import asyncio
+
+        async with self.semaphore:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=subprocess.DEVNULL if data is None else subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env)
+            try:
+                output, error = await process.communicate(data)
+            except BaseException:
+                # Cancelled, gpg must not outlive the request
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+
+        if process.returncode != 0:
+            raise gpg_failure(error_class, error)
+        return output
+
+    async def decrypt(self, data=None, path=None):
+        """ Decrypts data (bytes) or the file at path, returns bytes """
+        if data is None:
+            return await self._run(gpg_command(self.gpg_binary, '--decrypt',
+                                               path),
+                                   None, DecryptionError)
+        return await self._run(gpg_command(self.gpg_binary, '--decrypt'),
+                               data, DecryptionError)
+
+    async def encrypt(self, data, recipients):
+        """ Encrypts data (bytes) to the recipients, returns armored bytes
+        """
+        return await self._run(gpg_command(self.gpg_binary,
+                                           *encrypt_arguments(recipients)),
+                               data, EncryptionError)
+
+    async def recipients(self, uids):
+        """ Returns {uid: fingerprint} for the uids found in the keyring """
+        output = await self._run(list_keys_command(self.gpg_binary), None,
+                                 EncryptionError)
+        return parse_recipients(output, uids)
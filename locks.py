@@ -0,0 +1,60 @@
+# -*- coding: UTF-8
+
+import contextlib
+import fcntl
+import logging
+import os
+import threading
+import zlib
+
+log = logging.getLogger(__name__)
+
+# Number of lock files per backend
+STRIPES = 64
+
+
+class KeyLocks(object):
+    """ Exclusive locks for the keys of a backend, across processes
+
+    Keys are hashed onto a fixed number of lock files, so writers of
+    different keys rarely wait for each other while the number of files
+    stays bounded. A stripe is an flock'ed file for other processes and a
+    reentrant lock for the threads of this one, a thread already holding
+    a key may lock it again.
+    """
+
+    def __init__(self, directory, stripes=STRIPES):
+        self.directory = directory
+        self.stripes = stripes
+        self._locks = [threading.RLock() for _ in range(stripes)]
+        self._held = [0] * stripes
+        self._descriptors = [None] * stripes
+
+    def stripe(self, key):
+        return zlib.crc32(key.encode('UTF-8')) % self.stripes
+
+    @contextlib.contextmanager
+    def __call__(self, key):
+        """ Holds the lock for key while in the with block """
+        stripe = self.stripe(key)
+        with self._locks[stripe]:
+            if not self._held[stripe]:
+                os.makedirs(self.directory, mode=0o700, exist_ok=True)
+                descriptor = os.open(
+                    os.path.join(self.directory, "%02d.lock" % stripe),
+                    os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(descriptor, fcntl.LOCK_EX)
+                except BaseException:
+                    os.close(descriptor)
+                    raise
+                self._descriptors[stripe] = descriptor
+            self._held[stripe] += 1
+            try:
+                yield
+            finally:
+                self._held[stripe] -= 1
+                if not self._held[stripe]:
+                    # Closing the file releases the flock
+                    os.close(self._descriptors[stripe])
+                    self._descriptors[stripe] = None
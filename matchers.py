@@ -1,4 +1,6 @@
 # -*- coding: UTF-8
+from collections import Counter, defaultdict
+import heapq
 import re
 import logging
 
@@ -20,10 +22,132 @@ class RegexpMatcher(BaseMatcher):
         return self.regexp.search(string)
 
 
+WORD_SEPARATORS = re.compile(r'[\s/_.:@-]+')
+
+
+def words(string):
+    return [word for word in WORD_SEPARATORS.split(string.lower()) if word]
+
+
+def trigrams(string):
+    """ Returns the set of trigrams of the words in string
+
+    Words are padded like in pg_trgm so the start of a word weighs more
+    than its middle.
+    """
+    grams = set()
+    for word in words(string):
+        padded = "  " + word + " "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NGramIndex(object):
+    """ Trigram index over a list of keys
+
+    Looking up a pattern only touches the keys sharing a trigram with it,
+    not every key.
+    """
+
+    def __init__(self, keys):
+        self.keys = []
+        self.postings = defaultdict(list)
+        for key_id, key in enumerate(keys):
+            self.keys.append(key)
+            for gram in trigrams(key):
+                self.postings[gram].append(key_id)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def hits(self, grams):
+        """ Returns {key: number of the grams it contains} """
+        counts = Counter()
+        for gram in grams:
+            counts.update(self.postings.get(gram, ()))
+        return {self.keys[key_id]: count for key_id, count in counts.items()}
+
+
+class TokenMatcher(BaseMatcher):
+    """ Fuzzy matcher for whitespace separated tokens in any order
+
+    A key matches when it contains enough of the trigrams of the tokens,
+    so partial words and typos in longer words are forgiven. Matches are
+    ranked, keys containing the tokens verbatim, in their last part and
+    being short come first.
+    """
+
+    ranked = True
+    threshold = 0.6
+
+    def __init__(self, pattern):
+        log.debug(pattern)
+        self.tokens = words(pattern)
+        self.grams = trigrams(pattern)
+
+    def score(self, key, hits=None):
+        """ Returns a sortable score for key, None if it doesn't match """
+        if not self.grams:
+            return (1.0, 0, 0, -len(key))
+        if hits is None:
+            hits = len(self.grams & trigrams(key))
+        containment = hits / len(self.grams)
+        if containment < self.threshold:
+            return None
+
+        lowered = key.lower()
+        basename = lowered.rsplit('/', 1)[-1]
+        verbatim = sum(1 for token in self.tokens if token in lowered)
+        in_basename = sum(1 for token in self.tokens if token in basename)
+        return (containment, verbatim, in_basename, -len(key))
+
+    def matches(self, string):
+        return self.score(string) is not None
+
+    def scan(self, keys):
+        """ Yields (score, key) for the matching keys among keys
+
+        Counts the trigrams like score without building a set per key:
+        the keys are lowered and split into words in one go and the grams
+        are searched in the padded words of a key as one string. Trigrams
+        spanning two words there (two spaces after a letter) are never in
+        a pattern.
+        """
+        keys = list(keys)
+        padded = WORD_SEPARATORS.sub("   ", "\0".join(keys).lower())
+        count = len(self.grams)
+        for key, joined in zip(keys, padded.split("\0")):
+            joined = "  " + joined + " "
+            hits = sum(map(joined.__contains__, self.grams))
+            # The same test as in score, saving the call for most keys
+            if not count or hits / count >= self.threshold:
+                yield self.score(key, hits), key
+
+    def best(self, keys, limit=1):
+        """ Returns up to limit (score, key) from keys, best first
+
+        keys is an NGramIndex, then only the keys sharing a trigram with
+        the pattern are scored, or any iterable of keys to score them all.
+        """
+        if not isinstance(keys, NGramIndex):
+            candidates = self.scan(keys)
+        elif not self.grams:
+            candidates = ((self.score(key), key) for key in keys.keys)
+        else:
+            candidates = ((self.score(key, hits), key)
+                          for key, hits in keys.hits(self.grams).items())
+        return heapq.nlargest(limit,
+                              ((score, key) for score, key in candidates
+                               if score is not None),
+                              key=lambda match: match[0])
+
+
 ### Helpers ###################################################################
 
 def get_matcher(args, pattern):
-    if args.regexp is True:
+    if getattr(args, 'token', False) is True:
+        return TokenMatcher(pattern)
+    elif args.regexp is True:
         return RegexpMatcher(pattern)
     else:
         return None
@@ -0,0 +1,427 @@
+# -*- coding: UTF-8
+
+import contextlib
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+from cache import stable_mtime
+from walker import tree_events
+
+log = logging.getLogger(__name__)
+
+PACK_NAME = 'entries.pack'
+INDEX_NAME = 'entries.idx'
+LOCK_NAME = 'entries.lock'
+
+PACK_MAGIC = b'PWPACK1\n'
+INDEX_MAGIC = b'PWIDX01\n'
+
+# Record header: flags, key length, data length, CRC-32 of key and data
+RECORD = struct.Struct('>BHII')
+DELETED = 0x01
+
+# Index header: inode of the pack, size of the pack covered, number of keys
+INDEX_HEADER = struct.Struct('>QQQ')
+# Index slot: key offset in the key area, key length, data offset, length
+INDEX_SLOT = struct.Struct('>QHQI')
+INDEX_SLOTS = len(INDEX_MAGIC) + INDEX_HEADER.size
+
+# The index is written again once more records than this (or an eighth of
+# the indexed keys, if that is more) were appended after it
+INDEX_TAIL = 256
+
+
+class PackError(Exception):
+    pass
+
+
+# Files #######################################################################
+
+
+def pack_record(key, data):
+    """ Returns the record storing data (bytes) for key, None deletes it """
+    key_bytes = key.encode('UTF-8')
+    flags = DELETED if data is None else 0
+    data = data or b''
+    checksum = zlib.crc32(data, zlib.crc32(key_bytes))
+    return RECORD.pack(flags, len(key_bytes), len(data), checksum) + \
+        key_bytes + data
+
+
+def scan_records(buffer, start):
+    """ Yields (key, location, end) for the records in buffer from start
+
+    location is (offset, length) of the data or None for a deleted key,
+    end is where the record ends. The scan stops at the first incomplete
+    or damaged record, as left behind by an interrupted write.
+    """
+    size = len(buffer)
+    position = start
+    while position + RECORD.size <= size:
+        flags, key_length, data_length, checksum = \
+            RECORD.unpack_from(buffer, position)
+        key_start = position + RECORD.size
+        data_start = key_start + key_length
+        end = data_start + data_length
+        if end > size:
+            return
+        key_bytes = buffer[key_start:data_start]
+        if zlib.crc32(buffer[data_start:end],
+                      zlib.crc32(key_bytes)) != checksum:
+            return
+        try:
+            key = key_bytes.decode('UTF-8')
+        except UnicodeDecodeError:
+            return
+        yield key, None if flags & DELETED else (data_start, data_length), end
+        position = end
+
+
+def write_index(path, inode, end, entries):
+    """ Atomically writes the index of a pack
+
+    entries are (key, (offset, length)) sorted by key, end is the size of
+    the pack they cover.
+    """
+    slots = []
+    names = []
+    key_offset = 0
+    for key, (offset, length) in entries:
+        key_bytes = key.encode('UTF-8')
+        slots.append(INDEX_SLOT.pack(key_offset, len(key_bytes), offset,
+                                     length))
+        names.append(key_bytes)
+        key_offset += len(key_bytes)
+
+    directory = os.path.dirname(path)
+    descriptor, temp_path = tempfile.mkstemp(dir=directory,
+                                             prefix='.' + INDEX_NAME + '.')
+    try:
+        with os.fdopen(descriptor, 'wb') as index_file:
+            index_file.write(INDEX_MAGIC)
+            index_file.write(INDEX_HEADER.pack(inode, end, len(slots)))
+            index_file.write(b''.join(slots))
+            index_file.write(b''.join(names))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _map(path):
+    """ Returns (inode, read only mmap) of path, b'' for an empty file """
+    with open(path, 'rb') as mapped_file:
+        status = os.fstat(mapped_file.fileno())
+        if not status.st_size:
+            return status.st_ino, b''
+        return status.st_ino, mmap.mmap(mapped_file.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+
+
+# Pack ########################################################################
+
+
+class Pack(object):
+    """ The entries of a packed backend
+
+    Every entry is a record appended to a single pack file, a later record
+    for a key replaces (or deletes) the earlier ones. The index file maps
+    the keys, sorted, to their data for the start of the pack and is
+    binary searched through mmap instead of being read. Only the records
+    appended after it are scanned into memory when the pack is opened.
+    Writers serialize on a lock file, readers never wait.
+
+    Like KeyIndex it yields the keys (and walk events) of a backend.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, PACK_NAME)
+        self.index_path = os.path.join(self.directory, INDEX_NAME)
+        self.lock_path = os.path.join(self.directory, LOCK_NAME)
+        self.generation = 0
+        self.loaded = False
+        # Like KeyIndex, but appending updates the pack in place
+        self.stale = False
+        self._lock = threading.RLock()
+        self._inode = None
+        # The pack mapped into memory, and the end of its last good record
+        self._data = b''
+        self._end = 0
+        # The index mapped into memory
+        self._index = None
+        self._count = 0
+        self._names_at = 0
+        # key: location, for the records after the indexed part
+        self._tail = {}
+        self._sorted = None
+        self.log = logging.getLogger('packed.Pack')
+
+    @property
+    def inode(self):
+        """ Inode of the pack, it changes when the pack is compacted """
+        return self._inode
+
+    # Reading ################################################################
+
+    def _load_index(self, inode, size):
+        """ Maps the index if it belongs to the pack, returns the end """
+        self._index = None
+        self._count = 0
+        try:
+            _, index = _map(self.index_path)
+            if index[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+                raise PackError("Not an index")
+            index_inode, end, count = INDEX_HEADER.unpack_from(
+                index, len(INDEX_MAGIC))
+            if index_inode != inode or end > size:
+                self.log.debug("Index is for another pack")
+                return len(PACK_MAGIC)
+            names_at = INDEX_SLOTS + count * INDEX_SLOT.size
+            if names_at > len(index):
+                raise PackError("Index is truncated")
+        except FileNotFoundError:
+            return len(PACK_MAGIC)
+        except (OSError, struct.error, PackError) as error:
+            self.log.warning("Ignoring index %s: %s", self.index_path, error)
+            return len(PACK_MAGIC)
+
+        self._index = index
+        self._count = count
+        self._names_at = names_at
+        return end
+
+    def _open(self):
+        """ Maps the pack anew, after it was created or replaced """
+        self._tail = {}
+        try:
+            self._inode, self._data = _map(self.path)
+        except FileNotFoundError:
+            self._inode, self._data = None, b''
+            self._index = None
+            self._count = 0
+            self._end = 0
+            return
+
+        if self._data and self._data[:len(PACK_MAGIC)] != PACK_MAGIC:
+            raise PackError("%s is not a pack" % self.path)
+        self._end = self._load_index(self._inode, len(self._data))
+        self._scan()
+
+    def _scan(self):
+        for key, location, end in scan_records(self._data, self._end):
+            self._tail[key] = location
+            self._end = end
+        if self._end < len(self._data):
+            self.log.debug("Damaged records at the end of %s", self.path)
+
+    def update(self):
+        """ Catches up with records appended or a pack replaced since """
+        with self._lock:
+            try:
+                status = os.stat(self.path)
+                inode, size = status.st_ino, status.st_size
+            except FileNotFoundError:
+                inode, size = None, 0
+
+            if inode != self._inode or size < len(self._data):
+                self._open()
+            elif size > len(self._data):
+                self._inode, self._data = _map(self.path)
+                if self._inode != inode:
+                    # Replaced in the meantime
+                    self._open()
+                else:
+                    self._scan()
+            elif self.loaded:
+                return
+
+            self.loaded = True
+            self.generation += 1
+
+    def _slot(self, number):
+        key_offset, key_length, offset, length = INDEX_SLOT.unpack_from(
+            self._index, INDEX_SLOTS + number * INDEX_SLOT.size)
+        start = self._names_at + key_offset
+        return self._index[start:start + key_length], (offset, length)
+
+    def _find(self, key_bytes):
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            name, location = self._slot(middle)
+            if name < key_bytes:
+                low = middle + 1
+            elif name > key_bytes:
+                high = middle
+            else:
+                return location
+        return None
+
+    def locate(self, key):
+        """ Returns (offset, length) of the data for key, None if missing """
+        if not self.loaded:
+            self.update()
+        if key in self._tail:
+            return self._tail[key]
+        if self._index is not None:
+            return self._find(key.encode('UTF-8'))
+        return None
+
+    def read(self, key):
+        """ Returns the data stored for key (bytes) """
+        with self._lock:
+            location = self.locate(key)
+            if location is None:
+                raise FileNotFoundError(errno.ENOENT, "No such entry", key)
+            offset, length = location
+            return bytes(self._data[offset:offset + length])
+
+    def sorted_keys(self):
+        """ Returns all the keys, sorted """
+        if not self.loaded:
+            self.update()
+        if self._sorted is None or self._sorted[0] != self.generation:
+            tail = self._tail
+            keys = [key for key, location in tail.items()
+                    if location is not None]
+            for number in range(self._count):
+                key = self._slot(number)[0].decode('UTF-8')
+                if key not in tail:
+                    keys.append(key)
+            keys.sort()
+            self._sorted = (self.generation, keys)
+        return self._sorted[1]
+
+    def stamps(self):
+        """ Returns {path: mtime} like KeyIndex.stamps
+
+        The mtimes are taken before the pack is read again, so they are
+        never newer than the keys.
+        """
+        stamps = {}
+        for path in (self.directory, self.path):
+            try:
+                stamps[path] = stable_mtime(path)
+            except FileNotFoundError:
+                pass
+        self.update()
+        return stamps
+
+    def keys(self):
+        """ Yields (key, name) like KeyIndex.keys """
+        for key in self.sorted_keys():
+            yield key, key.rsplit(os.sep, 1)[-1]
+
+    def events(self):
+        """ Yields the same (event, path, name) tuples as walker.walk """
+        return tree_events(self.sorted_keys())
+
+    # Writing ################################################################
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            descriptor = os.open(self.lock_path, os.O_RDWR | os.O_CREAT,
+                                 0o600)
+            try:
+                fcntl.flock(descriptor, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(descriptor)
+
+    def append(self, items, expected=None):
+        """ Stores (key, data) items, data None deletes the key
+
+        All the records are written (and synced) at once. expected maps
+        keys to the location they must still have, otherwise nothing is
+        written and OSError is raised: FileExistsError for a key expected
+        to be missing.
+        """
+        records = b''.join(pack_record(key, data) for key, data in items)
+        with self._locked():
+            self.update()
+            for key, location in (expected or {}).items():
+                if self.locate(key) != location:
+                    if location is None:
+                        raise FileExistsError(errno.EEXIST, "Entry exists",
+                                              key)
+                    raise OSError(errno.EAGAIN, "Entry changed", key)
+
+            descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            with os.fdopen(descriptor, 'r+b') as pack_file:
+                size = os.fstat(descriptor).st_size
+                end = self._end if self._inode is not None else 0
+                if not size or not end:
+                    pack_file.write(PACK_MAGIC)
+                    end = len(PACK_MAGIC)
+                elif size > end:
+                    self.log.warning("Dropping damaged records at the end "
+                                     "of %s", self.path)
+                    pack_file.truncate(end)
+                pack_file.seek(end)
+                pack_file.write(records)
+                pack_file.flush()
+                os.fsync(descriptor)
+
+            self.update()
+            if len(self._tail) > max(INDEX_TAIL, self._count // 8):
+                self._save_index()
+
+    def _save_index(self):
+        entries = [(key, self.locate(key)) for key in self.sorted_keys()]
+        write_index(self.index_path, self._inode, self._end, entries)
+        self._end = self._load_index(self._inode, len(self._data))
+        self._tail = {}
+        self._scan()
+
+    def compact(self):
+        """ Rewrites the pack without replaced or deleted records
+
+        Returns the sizes of the pack (in bytes) before and after.
+        """
+        with self._locked():
+            self.update()
+            before = len(self._data)
+            data = self._data
+            entries = []
+            descriptor, temp_path = tempfile.mkstemp(
+                dir=self.directory, prefix='.' + PACK_NAME + '.')
+            try:
+                with os.fdopen(descriptor, 'wb') as pack_file:
+                    pack_file.write(PACK_MAGIC)
+                    end = len(PACK_MAGIC)
+                    for key in self.sorted_keys():
+                        offset, length = self.locate(key)
+                        record = pack_record(key,
+                                             data[offset:offset + length])
+                        pack_file.write(record)
+                        end += len(record)
+                        entries.append((key, (end - length, length)))
+                    pack_file.flush()
+                    os.fsync(descriptor)
+                    inode = os.fstat(descriptor).st_ino
+                os.replace(temp_path, self.path)
+            except BaseException:
+                try:
+                    os.unlink(temp_path)
+                except OSError:
+                    pass
+                raise
+
+            # An index left over for the old pack is ignored on its inode
+            write_index(self.index_path, inode, end, entries)
+            self.update()
+        return before, end
@@ -2,29 +2,42 @@
 # -*- coding: UTF-8
 
 import argparse
-import configparser
 import logging
 import os
-import subprocess
 import sys
 
-from backends import get_backends
-from display import Output
-from matchers import get_matcher
-
 log = logging.getLogger(__name__)
 
 # Globals #####################################################################
 
+# Options of the main parser that take a value, used to find the subcommand
+# before the parser is built
+VALUE_OPTIONS = ('-c', '--config', '-d', '--directory', '--socket',
+                 '--profile')
+
+# Subcommands (and aliases) that get a parser of their own
+COMMAND_NAMES = ('create', 'get', 'g', 'show', 'sh', 'list', 'ls', 'grep',
+                 'export', 'import', 'reencrypt', 'compact', 'daemon',
+                 'flush')
+
+# Commands that may need the configuration file to exist
+WRITE_COMMANDS = ('create', 'import', 'reencrypt', 'compact')
+
+# Matchers the daemon keeps for patterns asked for again
+MATCHER_CACHE_SIZE = 64
+
 # Helpers #####################################################################
 
 
 def set_pbcopy_clipboard(text):
+    import subprocess
     pbcopy_proc = subprocess.Popen(['pbcopy'], stdin=subprocess.PIPE)
     pbcopy_proc.communicate(bytes(text, encoding="UTF-8"))
 
 
 def set_xsel_clipboard(text, primary=True, secondary=True, clipboard=True):
+    import subprocess
+
     if primary:
         xsel_proc = subprocess.Popen(['xsel', '-pi'], stdin=subprocess.PIPE)
         xsel_proc.communicate(bytes(text, encoding="UTF-8"))
@@ -38,6 +51,23 @@ def set_xsel_clipboard(text, primary=True, secondary=True, clipboard=True):
         xsel_proc.communicate(bytes(text, encoding="UTF-8"))
 
 
+def positive_int(value):
+    """ argparse type for counts that have to be at least one """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive number" %
+                                         value)
+    return number
+
+
+def silence_stdout():
+    """ Sends stdout to /dev/null once the reader of a pipe went away
+
+    Python would otherwise complain again when it flushes stdout at exit.
+    """
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
 def set_clipboard(text):
     import platform
     system = platform.system()
@@ -49,9 +79,206 @@ def set_clipboard(text):
         print(format("I don't know how to set clipboard on %s", system))
 
 
-def parse_configfile(file_name=None):
+def find_password(backends, matcher, pattern=None):
+    from backends import find_key
+    found = find_key(backends, matcher, pattern)
+    if found is not None:
+        backend, key = found
+        return backend.password_for_key(key)
+
+
+def find_entry(backends, matcher, pattern=None):
+    from backends import find_key
+    found = find_key(backends, matcher, pattern)
+    if found is not None:
+        backend, key = found
+        return backend.entry_for_key(key)
+
+
+def write_entry(backends, matcher, pattern=None, stream=None):
+    """ Copies the matching entry as stored (binary too) to stream
+
+    Returns False if there is no matching entry.
+    """
+    import shutil
+    from backends import find_key
+    found = find_key(backends, matcher, pattern)
+    if found is None:
+        return False
+    backend, key = found
+    stream = stream or sys.stdout.buffer
+    with backend.reader_for_key(key) as reader:
+        shutil.copyfileobj(reader, stream)
+    stream.flush()
+    return True
+
+
+def list_keys(backends, matcher, output, max_depth=None, summary=False):
+    from backends import ordered
+    for backend in ordered(backends):
+        if max_depth is None and not summary:
+            backend.filter(output, matcher)
+        else:
+            backend.outline(output, matcher, max_depth, summary)
+
+    output.pretty_print()
+
+
+def stream_keys(backends, matcher, writer, limit=None):
+    """ Writes the matching keys one by one, stops after limit keys """
+    import itertools
+    from backends import ordered
+    keys = ((backend.name, key)
+            for backend in ordered(backends)
+            for key in backend.keys(matcher))
+    for storage, key in itertools.islice(keys, limit):
+        writer.key(storage, key)
+
+
+# Daemon ######################################################################
+
+CLIENT_COMMANDS = {
+    'g': 'get', 'get': 'get',
+    'sh': 'show', 'show': 'show',
+    'ls': 'list', 'list': 'list',
+}
+
+
+def daemon_request(args):
+    """ Returns the daemon request for args, None if it can't be served """
+    command = CLIENT_COMMANDS.get(args.command)
+    if command is None:
+        return None
+    if 'list' == command and 'tree' != args.format:
+        # Streamed listings are written while the backends are walked
+        return None
+
+    return {
+        'command': command,
+        'directory': os.path.abspath(os.path.expanduser(args.directory)),
+        'pattern': args.pattern,
+        'regexp': args.regexp,
+        'token': args.token,
+        'max_depth': getattr(args, 'max_depth', None),
+        'summary': getattr(args, 'summary', False),
+    }
+
+
+class DaemonDispatcher(object):
+    """ Answers client requests from backends and matchers kept in memory
+
+    With an EntryCache decrypted entries are kept in memory as well.
+    """
+
+    def __init__(self, directory, entries=None):
+        from collections import OrderedDict
+        from cache import BackendManifest
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.load()
+        self.manifest = BackendManifest(self.directory)
+        # Least recently used first
+        self.matchers = OrderedDict()
+        self.entries = entries
+        # (generations of the indexes, sorted <storage>/<key> lines)
+        self.key_list = None
+
+    def load(self, reload=False):
+        from backends import get_backends
+        self.backends = get_backends(self.directory, reload=reload)
+        for backend in self.backends.values():
+            # Serving many lookups the trigram indexes pay off
+            backend.use_ngrams = True
+
+    def idle(self):
+        if self.entries is not None:
+            self.entries.expire()
+
+    def cached_entry(self, matcher, pattern):
+        """ Returns (backend, content) for the matching entry or None """
+        from backends import find_key
+        found = find_key(self.backends, matcher, pattern)
+        if found is not None:
+            return found[0], self.entries.content(*found)
+
+    def completions(self, prefix, storages=False):
+        """ Returns the keys (or storages) for prefix, like completion """
+        from completion import complete, key_lines
+        if storages:
+            return [name for name in sorted(self.backends)
+                    if name.startswith(prefix)]
+
+        generations = tuple(
+            (name, id(backend.index), backend.index.generation)
+            for name, backend in sorted(self.backends.items()))
+        if self.key_list is None or self.key_list[0] != generations:
+            self.key_list = (generations, key_lines(self.backends))
+        return complete(self.key_list[1], prefix)
+
+    def matcher(self, message):
+        from matchers import get_matcher
+        cache_key = (message['pattern'], message['regexp'], message['token'])
+        if cache_key in self.matchers:
+            self.matchers.move_to_end(cache_key)
+        else:
+            match_args = argparse.Namespace(regexp=message['regexp'],
+                                            token=message['token'])
+            self.matchers[cache_key] = get_matcher(match_args,
+                                                   message['pattern'])
+            if len(self.matchers) > MATCHER_CACHE_SIZE:
+                self.matchers.popitem(last=False)
+        return self.matchers[cache_key]
+
+    def __call__(self, message):
+        command = message.get('command')
+        if 'ping' == command:
+            return 'pong'
+        if 'flush' == command:
+            if self.entries is None:
+                return 0
+            return self.entries.flush()
+        if message.get('directory') != self.directory:
+            raise ValueError("Daemon serves %s" % self.directory)
+
+        if self.manifest.load() is None:
+            log.debug("Backends changed, reloading")
+            self.load(reload=True)
+
+        for backend in self.backends.values():
+            backend.index.update()
+
+        if 'complete' == command:
+            return self.completions(message['prefix'],
+                                    message.get('storages', False))
+
+        matcher = self.matcher(message)
+        if command in ('get', 'show') and self.entries is not None:
+            found = self.cached_entry(matcher, message['pattern'])
+            if found is None:
+                return None
+            backend, content = found
+            if 'get' == command:
+                return backend.password_from(content)
+            return content.decode('UTF-8')
+        elif 'get' == command:
+            return find_password(self.backends, matcher, message['pattern'])
+        elif 'show' == command:
+            return find_entry(self.backends, matcher, message['pattern'])
+        elif 'list' == command:
+            import io
+            from display import Output
+            listing = io.StringIO()
+            list_keys(self.backends, matcher if message['pattern'] else None,
+                      Output(stream=listing), message.get('max_depth'),
+                      message.get('summary', False))
+            return listing.getvalue()
+
+        raise ValueError("Unknown command %s" % command)
+
+
+def parse_configfile(file_name=None, create_missing=True):
     """ Parse configuration file and return config
     """
+    import configparser
     log = logging.getLogger('parse_configfile')
     defaults = {
         'global': {
@@ -78,6 +305,9 @@ def parse_configfile(file_name=None):
             sys.exit(2)
 
         except FileNotFoundError:
+            if not create_missing:
+                log.debug("Configuration file does not exist")
+                return parser
             log.warning("Configuration file does not exist")
             try:
                 log.info("Creating file with default values")
@@ -89,11 +319,49 @@ def parse_configfile(file_name=None):
     return parser
 
 
+def requested_command(arguments):
+    """ Returns the first positional argument, the subcommand, if any """
+    arguments = iter(arguments)
+    for argument in arguments:
+        if argument in VALUE_OPTIONS:
+            next(arguments, None)
+        elif not argument.startswith('-'):
+            return argument
+    return None
+
+
+def set_completers(subparsers):
+    """ Completes keys and storage names from the key list or the daemon
+    """
+    from completion import KeyCompleter
+    completers = {
+        'pattern': KeyCompleter(),
+        'key': KeyCompleter(storage_argument='storage'),
+        'storage': KeyCompleter(storages=True),
+        'storages': KeyCompleter(storages=True),
+    }
+    # Aliases share their parser
+    for subparser in set(subparsers.choices.values()):
+        for action in subparser._actions:
+            if action.dest in completers:
+                action.completer = completers[action.dest]
+
+
 def parse_commandline(command_line):
     """ Parse arguments and return configuration
+
+    Only the parser for the requested subcommand is built, unless help or
+    completion needs all of them.
     """
     log = logging.getLogger('parse_commandline')
 
+    completing = '_ARGCOMPLETE' in os.environ
+    command = requested_command(command_line[1:])
+    build_all = completing or command not in COMMAND_NAMES
+
+    def wanted(*names):
+        return build_all or command in names
+
     parser = argparse.ArgumentParser(description='Stores information in files')
     # parser.add_argument('command', metavar='<command>', choices=COMMANDS,
     #                     help="""""")
@@ -108,6 +376,17 @@ def parse_commandline(command_line):
                         help=('directory with storage backends (if different '
                               'from default or configuration)'))
 
+    parser.add_argument('--socket', default=None,
+                        help='unix socket of the daemon')
+    parser.add_argument('--no-daemon', action='store_true', default=False,
+                        help="don't ask a running daemon, always work locally")
+    parser.add_argument('--timings', action='store_true', default=False,
+                        help='write the time spent per phase and counters '
+                             'as JSON to stderr')
+    parser.add_argument('--profile', metavar='FILE', default=None,
+                        help="write cProfile statistics to FILE ('-' for a "
+                             "summary on stderr)")
+
     # parser.add_argument('--debug', nargs=1, metavar="DEBUGLEVEL",
     #                     default='INFO',
     #                     help=("The debug level to use for logging"))
@@ -118,59 +397,209 @@ def parse_commandline(command_line):
     matchers.add_argument('-r', '--regexp',
                           help='use regular expression matcher',
                           action='store_true', default=True)
-    # matchers.add_argument('-t', '--token', help='use token expression matcher',
-    #                       action='store_true', default=False)
+    matchers.add_argument('-t', '--token',
+                          help='use ranked token (fuzzy) matcher',
+                          action='store_true', default=False)
 
     # Subparsers #############################################################
     subparsers = parser.add_subparsers(dest='command', title='subcommands',
                                        description='valid subcommands')
 
     ###### Create ############################################################
-    create_parser = subparsers.add_parser(
-        'create', help='create a new entry',
-        description='''Create a new entry for the given <key> in an existing
-                       backend''')
-    create_parser.add_argument('storage', metavar='<storage>', help="storage")
-    create_parser.add_argument('key', metavar='<key>',
-                               help="key for the new entry")
+    if wanted('create'):
+        create_parser = subparsers.add_parser(
+            'create', help='create a new entry',
+            description='''Create a new entry for the given <key> in an
+                           existing backend''')
+        create_parser.add_argument('storage', metavar='<storage>',
+                                   help="storage")
+        create_parser.add_argument('key', metavar='<key>',
+                                   help="key for the new entry")
 
     ###### Get ###############################################################
-    get_parser = subparsers.add_parser(
-        'get', aliases=['g'], help='get password (first line) from an entry',
-        description=('Get the password (first line) from an entry described '
-                     'by <pattern>'),
-        parents=[match_parser])
-    get_parser.add_argument('pattern', metavar='<pattern>',
-                            help="pattern for the wanted entry")
-    get_parser.add_argument('--clipboard', action="store_true",
-                            help="Set clipboard instead of print to stdout")
+    if wanted('get', 'g'):
+        get_parser = subparsers.add_parser(
+            'get', aliases=['g'],
+            help='get password (first line) from an entry',
+            description=('Get the password (first line) from an entry '
+                         'described by <pattern>'),
+            parents=[match_parser])
+        get_parser.add_argument('pattern', metavar='<pattern>',
+                                help="pattern for the wanted entry")
+        get_parser.add_argument(
+            '--clipboard', action="store_true",
+            help="Set clipboard instead of print to stdout")
 
     ###### Show ##############################################################
-    show_parser = subparsers.add_parser(
-        'show', aliases=['sh'], help='show an entry',
-        description='show the entry described by <pattern>',
-        parents=[match_parser])
-    show_parser.add_argument('-c', '--stdout', help='print password on stdout',
-                             action='store_true', default=False)
-    show_parser.add_argument('pattern', metavar='<pattern>',
-                             help="pattern for the wanted entry")
+    if wanted('show', 'sh'):
+        show_parser = subparsers.add_parser(
+            'show', aliases=['sh'], help='show an entry',
+            description='show the entry described by <pattern>',
+            parents=[match_parser])
+        show_parser.add_argument('-c', '--stdout',
+                                 help='print password on stdout',
+                                 action='store_true', default=False)
+        show_parser.add_argument('pattern', metavar='<pattern>',
+                                 help="pattern for the wanted entry")
 
     ###### List ##############################################################
-    list_parser = subparsers.add_parser(
-        'list', aliases=['ls'], help='list keys',
-        description='show keys matching <pattern> (or all)',
-        parents=[match_parser])
-    list_parser.add_argument('pattern', metavar='<pattern>', help='pattern',
-                             nargs='?', default='')
+    if wanted('list', 'ls'):
+        list_parser = subparsers.add_parser(
+            'list', aliases=['ls'], help='list keys',
+            description='show keys matching <pattern> (or all)',
+            parents=[match_parser])
+        list_parser.add_argument('pattern', metavar='<pattern>',
+                                 help='pattern', nargs='?', default='')
+        list_parser.add_argument(
+            '--format', choices=('tree', 'plain', 'null', 'jsonl'),
+            default='tree',
+            help='''tree for people, or one <storage>/<key> per line, NUL
+                    terminated or as JSON objects for other programs''')
+        list_parser.add_argument(
+            '--limit', type=positive_int, metavar='N', default=None,
+            help='stop after N keys (plain, null and jsonl formats)')
+        list_parser.add_argument(
+            '--max-depth', type=int, metavar='N', default=None,
+            help='''show N levels, deeper directories only with their key
+                    count (tree format)''')
+        list_parser.add_argument(
+            '--summary', action='store_true',
+            help='show directories with their key counts instead of keys '
+                 '(tree format)')
+
+    ###### Grep ##############################################################
+    if wanted('grep'):
+        grep_parser = subparsers.add_parser(
+            'grep', help='search the content of entries',
+            description='''Show the lines matching the regular expression
+                           <regexp> in the entries with keys matching
+                           <pattern> (or all), decrypting them in parallel''',
+            parents=[match_parser])
+        grep_parser.add_argument('content', metavar='<regexp>',
+                                 help='regular expression for the lines')
+        grep_parser.add_argument('pattern', metavar='<pattern>',
+                                 help='pattern for the keys to search',
+                                 nargs='?', default='')
+        grep_parser.add_argument('-i', '--ignore-case', action='store_true',
+                                 help='ignore case when matching lines')
+        grep_parser.add_argument('-l', '--files-with-matches',
+                                 action='store_true',
+                                 help='only show the keys of the entries')
+        grep_parser.add_argument('-j', '--jobs', type=int, default=None,
+                                 metavar='N',
+                                 help='decrypt at most N entries at once')
+
+    ###### Export ############################################################
+    if wanted('export'):
+        export_parser = subparsers.add_parser(
+            'export', help='write all entries to stdout',
+            description='''Write the entries with keys matching <pattern>
+                           (or all) to stdout as JSON lines or a tar
+                           archive, decrypting them in parallel''',
+            parents=[match_parser])
+        export_parser.add_argument('pattern', metavar='<pattern>',
+                                   help='pattern for the keys to export',
+                                   nargs='?', default='')
+        export_parser.add_argument('--format', choices=('jsonl', 'tar'),
+                                   default='jsonl',
+                                   help='format of the export')
+        export_parser.add_argument('-j', '--jobs', type=int, default=None,
+                                   metavar='N',
+                                   help='decrypt at most N entries at once')
+        export_parser.add_argument('-q', '--quiet', action='store_true',
+                                   help="don't report progress on stderr")
+
+    ###### Import ############################################################
+    if wanted('import'):
+        import_parser = subparsers.add_parser(
+            'import', help='create many entries at once',
+            description='''Create entries in <storage> from the JSON lines
+                           written by export or from the files in a
+                           directory, encrypting them in parallel. Existing
+                           entries are skipped so an interrupted import can
+                           simply be run again''')
+        import_parser.add_argument('storage', metavar='<storage>',
+                                   help='storage')
+        import_parser.add_argument('source', metavar='<source>', nargs='?',
+                                   default='-',
+                                   help='JSONL file or directory (default '
+                                        'JSON lines on stdin)')
+        import_parser.add_argument('--overwrite', action='store_true',
+                                   help='replace existing entries')
+        import_parser.add_argument('-j', '--jobs', type=int, default=None,
+                                   metavar='N',
+                                   help='encrypt at most N entries at once')
+        import_parser.add_argument('-q', '--quiet', action='store_true',
+                                   help="don't report progress on stderr")
+
+    ###### Reencrypt #########################################################
+    if wanted('reencrypt'):
+        reencrypt_parser = subparsers.add_parser(
+            'reencrypt', help='re-encrypt entries to the configured keys',
+            description='''Re-encrypt the entries of the GPG backends
+                           <storage> (or all) that are not encrypted to the
+                           keys in their storage.conf, in parallel. Progress
+                           is kept in a checkpoint so an interrupted run
+                           continues where it stopped''')
+        reencrypt_parser.add_argument('storages', metavar='<storage>',
+                                      nargs='*', help='storage')
+        reencrypt_parser.add_argument(
+            '-n', '--dry-run', action='store_true',
+            help='only show the entries that would be re-encrypted')
+        reencrypt_parser.add_argument(
+            '--restart', action='store_true',
+            help='ignore the checkpoint of an earlier run')
+        reencrypt_parser.add_argument('-j', '--jobs', type=int, default=None,
+                                      metavar='N',
+                                      help='re-encrypt at most N entries at '
+                                           'once')
+        reencrypt_parser.add_argument('-q', '--quiet', action='store_true',
+                                      help="don't report progress on stderr")
+
+    ###### Compact ###########################################################
+    if wanted('compact'):
+        compact_parser = subparsers.add_parser(
+            'compact', help='drop replaced entries from packed backends',
+            description='''Rewrite the pack files of the packed backends
+                           <storage> (or all) without replaced and deleted
+                           entries''')
+        compact_parser.add_argument('storages', metavar='<storage>',
+                                    nargs='*', help='storage')
+
+    ###### Daemon ############################################################
+    if wanted('daemon'):
+        daemon_parser = subparsers.add_parser(
+            'daemon',
+            help='serve get, show and list from a background process',
+            description='''Keep backends, key indexes and matchers in memory
+                           and answer get, show and list requests from other
+                           invocations over a unix socket''')
+        daemon_parser.add_argument(
+            '--cache-ttl', type=float, default=0, metavar='SECONDS',
+            help='keep decrypted entries in memory for SECONDS (default 0, '
+                 'no caching)')
+        daemon_parser.add_argument(
+            '--cache-size', type=int, default=1 << 20, metavar='BYTES',
+            help='keep at most BYTES of decrypted entries (default 1 MiB)')
+
+    if wanted('flush'):
+        subparsers.add_parser(
+            'flush', help='make the daemon forget decrypted entries',
+            description='''Drop the decrypted entries cached by a running
+                           daemon''')
+
     ###### Help ##############################################################
     help_parser = subparsers.add_parser('help', help='show help')
     help_parser.add_argument('help_command', metavar='command', nargs='?')
 
-    try:
-        import argcomplete
-        argcomplete.autocomplete(parser)
-    except ImportError:
-        log.debug("No argcomplete found")
+    if completing:
+        try:
+            import argcomplete
+        except ImportError:
+            log.debug("No argcomplete found")
+        else:
+            set_completers(subparsers)
+            argcomplete.autocomplete(parser)
 
     args = parser.parse_args(command_line[1:])
     if 'help' == args.command:
@@ -203,46 +632,234 @@ if '__main__' == __name__:
 
     args = parse_commandline(sys.argv)
 
+    import timings
+    if args.timings:
+        import atexit
+        timings.enable()
+        atexit.register(timings.report, sys.stderr)
+    if args.profile is not None:
+        timings.profile(args.profile)
+
+    message = None if args.no_daemon else daemon_request(args)
+    if message is not None or args.command in ['daemon', 'flush']:
+        import daemon
+        socket_path = args.socket or daemon.socket_path()
+
+    if message is not None:
+        response = daemon.request(socket_path, message)
+        if response is not None and 'ok' == response['status']:
+            result = response['output']
+            if result is None:
+                pass
+            elif 'get' == message['command'] and args.clipboard is True:
+                set_clipboard(result)
+            elif message['command'] in ('list', 'show'):
+                print(result, end='')
+            else:
+                print(result)
+            sys.exit(0)
+        elif response is not None:
+            log.debug("Daemon refused request: %s", response['message'])
+
+    if args.command in ['flush']:
+        response = daemon.request(socket_path, {'command': 'flush'})
+        if response is None:
+            log.error("No daemon listening on %s", socket_path)
+            sys.exit(1)
+        log.info("Flushed %s entries", response.get('output'))
+        sys.exit(0)
+
     config_path = os.path.expanduser(args.config)
     log.debug("Configfile is %s", config_path)
 
-    configuration = parse_configfile(config_path)
+    # The configuration is only written with defaults when a command that
+    # changes the store runs
+    with timings.phase('config'):
+        configuration = parse_configfile(
+            config_path, create_missing=args.command in WRITE_COMMANDS)
 
-    output = Output()
+    from backends import get_backends
+    from matchers import get_matcher
 
-    if args.command in ['ls', 'list']:
+    if args.command in ['ls', 'list'] and 'tree' != args.format:
+        from display import KeyWriter
         backends = get_backends(args.directory)
         matcher = get_matcher(args, args.pattern)
-        for backend in backends.values():
-            backend.filter(output, matcher)
-
-        output.pretty_print()
+        try:
+            stream_keys(backends, matcher, KeyWriter(args.format),
+                        args.limit)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            silence_stdout()
+
+    elif args.command in ['ls', 'list']:
+        from display import Output
+        backends = get_backends(args.directory)
+        # Without a pattern every key is listed, and counted from the index
+        matcher = get_matcher(args, args.pattern) if args.pattern else None
+        try:
+            list_keys(backends, matcher, Output(), args.max_depth,
+                      args.summary)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            silence_stdout()
 
     elif args.command in ['g', 'get']:
+        from errors import GPGError
         backends = get_backends(args.directory)
         matcher = get_matcher(args, args.pattern)
-        for backend in backends.values():
-            password = backend.get_password(matcher)
-            if password is not None:
-                if args.clipboard is True:
-                    set_clipboard(password)
-                else:
-                    print(password)
-                break
+        try:
+            password = find_password(backends, matcher, args.pattern)
+        except GPGError as error:
+            log.error("Can't decrypt entry: %s", error)
+            sys.exit(1)
+        if password is not None:
+            if args.clipboard is True:
+                set_clipboard(password)
+            else:
+                print(password)
 
     elif args.command in ['sh', 'show']:
+        from errors import GPGError
         backends = get_backends(args.directory)
         matcher = get_matcher(args, args.pattern)
-        for backend in backends.values():
-            password = backend.get_entry(matcher)
-            if password is not None:
-                print(password)
-                break
+        try:
+            write_entry(backends, matcher, args.pattern)
+        except BrokenPipeError:
+            silence_stdout()
+        except GPGError as error:
+            log.error("Can't decrypt entry: %s", error)
+            sys.exit(1)
+
+    elif args.command in ['grep']:
+        import bulk
+        import re
+        backends = get_backends(args.directory)
+        matcher = get_matcher(args, args.pattern)
+        try:
+            found = bulk.grep(backends, args.content, matcher,
+                              flags=re.IGNORECASE if args.ignore_case else 0,
+                              workers=args.jobs,
+                              names_only=args.files_with_matches)
+        except BrokenPipeError:
+            silence_stdout()
+            found = True
+        sys.exit(0 if found else 1)
+
+    elif args.command in ['export']:
+        import bulk
+        backends = get_backends(args.directory)
+        matcher = get_matcher(args, args.pattern)
+        try:
+            stats = bulk.export(
+                backends, matcher, args.format, workers=args.jobs,
+                progress_stream=None if args.quiet else sys.stderr)
+        except BrokenPipeError:
+            silence_stdout()
+            sys.exit(1)
+        sys.exit(1 if stats['failures'] else 0)
+
+    elif args.command in ['import']:
+        import bulk
+        from errors import GPGError
+        backends = get_backends(args.directory)
+        backend = backends.get(args.storage, None)
+        if backend is None:
+            print("There is no such storage")
+            sys.exit(2)
+        try:
+            stats = bulk.import_entries(
+                backend, bulk.import_source(args.source), workers=args.jobs,
+                overwrite=args.overwrite,
+                progress_stream=None if args.quiet else sys.stderr)
+        except (ValueError, GPGError) as error:
+            # Keys missing in the keyring, or gpg failing to list them
+            log.error("Can't import into %s: %s", args.storage, error)
+            sys.exit(1)
+        sys.exit(1 if stats['failures'] else 0)
+
+    elif args.command in ['reencrypt']:
+        import bulk
+        from backends import GPGBackend
+        from errors import GPGError
+        backends = get_backends(args.directory)
+        names = args.storages or sorted(
+            name for name, backend in backends.items()
+            if isinstance(backend, GPGBackend))
+        failed = False
+        try:
+            for name in names:
+                backend = backends.get(name, None)
+                if not isinstance(backend, GPGBackend):
+                    log.error("There is no GPG storage %s", name)
+                    failed = True
+                    continue
+                try:
+                    stats = bulk.reencrypt(
+                        backend, workers=args.jobs, dry_run=args.dry_run,
+                        restart=args.restart,
+                        progress_stream=None if args.quiet else sys.stderr)
+                    failed = failed or bool(stats['failures'])
+                except (ValueError, GPGError) as error:
+                    log.error("Can't re-encrypt %s: %s", name, error)
+                    failed = True
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # The dry run lists the entries it would re-encrypt
+            silence_stdout()
+            failed = True
+        sys.exit(1 if failed else 0)
+
+    elif args.command in ['compact']:
+        from backends import PackedBackend
+        backends = get_backends(args.directory)
+        names = args.storages or sorted(
+            name for name, backend in backends.items()
+            if isinstance(backend, PackedBackend))
+        failed = False
+        for name in names:
+            backend = backends.get(name, None)
+            if not isinstance(backend, PackedBackend):
+                log.error("There is no packed storage %s", name)
+                failed = True
+                continue
+            before, after = backend.compact()
+            log.info("Compacted %s from %d to %d bytes", name, before, after)
+        sys.exit(1 if failed else 0)
+
+    elif args.command in ['daemon']:
+        entries = None
+        if args.cache_ttl > 0:
+            from cache import EntryCache
+            entries = EntryCache(max_bytes=args.cache_size,
+                                 ttl=args.cache_ttl)
+        dispatcher = DaemonDispatcher(args.directory, entries)
+        try:
+            server = daemon.Daemon(socket_path, dispatcher,
+                                   idle=dispatcher.idle)
+        except RuntimeError as error:
+            log.error(error)
+            sys.exit(1)
+        server.serve()
 
     elif args.command in ['create']:
         backends = get_backends(args.directory)
         backend = backends.get(args.storage, None)
         if backend is None:
             print("There is no such storage")
+            sys.exit(2)
 
-        backend.create(args.key)
+        try:
+            backend.create(args.key)
+        except FileExistsError:
+            log.error("%s already exists in %s", args.key, args.storage)
+            sys.exit(1)
+        except NotADirectoryError as error:
+            log.error("Can't create %s in %s: %s is a file", args.key,
+                      args.storage, error.filename)
+            sys.exit(1)
+        except ValueError as error:
+            # An invalid key or keys missing in the keyring
+            log.error("Can't create %s in %s: %s", args.key, args.storage,
+                      error)
+            sys.exit(1)
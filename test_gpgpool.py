@@ -0,0 +1,151 @@
+# -*- coding: UTF-8
+""" Tests of the gpg pool and of the packet header parser """
+
+import base64
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from errors import DecryptionError, PacketError
+from gpgpool import GPGPool, HIDDEN_KEY_ID, matches_recipients, \
+    recipient_key_ids
+
+RECIPIENT = 'test@example.invalid'
+
+
+def pkesk(key_id):
+    """ Returns an old format public key encrypted session key packet """
+    body = b'\x03' + key_id + b'\x01' + b'\x00' * 8
+    return bytes([0x80 | (1 << 2), len(body)]) + body
+
+
+def armored(message):
+    """ Returns message (bytes) as an ASCII armored message """
+    encoded = base64.b64encode(message)
+    lines = [encoded[start:start + 64]
+             for start in range(0, len(encoded), 64)]
+    return b'\n'.join([b'-----BEGIN PGP MESSAGE-----', b''] + lines +
+                      [b'=abcd', b'-----END PGP MESSAGE-----', b''])
+
+
+# Encrypted data that is never read, after a new format header
+ENCRYPTED_DATA = b'\xd2\x05\x01data'
+
+
+class PacketTest(unittest.TestCase):
+
+    def test_binary(self):
+        message = pkesk(bytes(range(8))) + pkesk(b'\xff' * 8) + \
+            ENCRYPTED_DATA
+        self.assertEqual(['0001020304050607', 'FFFFFFFFFFFFFFFF'],
+                         recipient_key_ids(io.BytesIO(message)))
+
+    def test_armored(self):
+        message = armored(pkesk(bytes(range(8))) + ENCRYPTED_DATA)
+        self.assertEqual(['0001020304050607'],
+                         recipient_key_ids(io.BytesIO(message)))
+
+    def test_new_format_lengths(self):
+        body = b'\x03' + bytes(range(8)) + b'\x01' + b'\x00' * 300
+        two_octets = bytes([0xc1, ((len(body) - 192) >> 8) + 192,
+                            (len(body) - 192) & 0xff]) + body
+        five_octets = b'\xc1\xff' + len(body).to_bytes(4, 'big') + body
+        message = two_octets + five_octets + ENCRYPTED_DATA
+        self.assertEqual(['0001020304050607'] * 2,
+                         recipient_key_ids(io.BytesIO(message)))
+
+    def test_hidden_recipient(self):
+        body = b'\x06' + b'\x00' * 20
+        message = bytes([0xc1, len(body)]) + body + ENCRYPTED_DATA
+        self.assertEqual([HIDDEN_KEY_ID],
+                         recipient_key_ids(io.BytesIO(message)))
+
+    def test_not_encrypted(self):
+        for message in (b'plain text', b'\xc2\x01\x00' + ENCRYPTED_DATA,
+                        pkesk(bytes(range(8)))):
+            with self.assertRaises(PacketError):
+                recipient_key_ids(io.BytesIO(message))
+
+    def test_matches_recipients(self):
+        expected = {'A': {'1', '2'}, 'B': {'3'}}
+        self.assertTrue(matches_recipients(['1', '3'], expected))
+        self.assertTrue(matches_recipients(['1', '2', '3'], expected))
+        self.assertFalse(matches_recipients(['1'], expected))
+        self.assertFalse(matches_recipients(['1', '3', '4'], expected))
+        self.assertFalse(matches_recipients([HIDDEN_KEY_ID, '3'], expected))
+
+
+@unittest.skipIf(shutil.which('gpg') is None, "gpg is not installed")
+class GPGPoolTest(unittest.TestCase):
+    """ Runs gpg with a passphrase-less key in a throwaway GNUPGHOME """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.home = os.path.join(cls.directory, 'gnupg')
+        os.makedirs(cls.home, mode=0o700)
+        subprocess.run(['gpg', '--homedir', cls.home, '--batch', '--quiet',
+                        '--passphrase', '', '--quick-gen-key', RECIPIENT,
+                        'future-default', 'default', 'never'],
+                       check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+
+    @classmethod
+    def tearDownClass(cls):
+        subprocess.run(['gpgconf', '--homedir', cls.home, '--kill',
+                        'gpg-agent'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def setUp(self):
+        self.pool = GPGPool(workers=2, gnupg_home=self.home)
+        self.addCleanup(self.pool.close)
+
+    def test_round_trip(self):
+        data = b'password\nuser: someone\n\xff\x00'
+        encrypted = self.pool.encrypt(data, [RECIPIENT])
+        self.assertTrue(encrypted.startswith(b'-----BEGIN PGP MESSAGE'))
+        self.assertEqual(data, self.pool.decrypt(encrypted))
+
+        path = os.path.join(self.directory, 'entry')
+        with open(path, 'wb') as entry_file:
+            entry_file.write(encrypted)
+        self.assertEqual(data, self.pool.decrypt(path=path))
+        with self.pool.decrypt_reader(path) as reader:
+            self.assertEqual(b'password\n', reader.readline())
+
+    def test_run(self):
+        entries = [('%d' % number).encode('UTF-8') for number in range(6)]
+        encrypted = dict(self.pool.run(
+            lambda data: self.pool.encrypt(data, [RECIPIENT]),
+            ((data, data) for data in entries)))
+        decrypted = dict(self.pool.run(self.pool.decrypt,
+                                       encrypted.items()))
+        self.assertEqual({data: data for data in entries}, decrypted)
+
+        failed = dict(self.pool.run(self.pool.decrypt,
+                                    [('broken', b'not a message')]))
+        self.assertIsInstance(failed['broken'], DecryptionError)
+        self.assertEqual(1, self.pool.stats()['failures'])
+
+    def test_recipient_key_ids(self):
+        fingerprint = self.pool.recipients([RECIPIENT])[RECIPIENT]
+        expected = self.pool.key_ids([fingerprint])
+        encrypted = self.pool.encrypt(b'secret', [RECIPIENT])
+        binary = subprocess.run(self.pool.command('--dearmor'),
+                                input=encrypted, stdout=subprocess.PIPE,
+                                env=self.pool.env, check=True).stdout
+
+        for message in (encrypted, binary):
+            key_ids = recipient_key_ids(io.BytesIO(message))
+            self.assertEqual(1, len(key_ids))
+            self.assertTrue(matches_recipients(key_ids, expected))
+            self.assertFalse(matches_recipients(
+                key_ids, dict(expected, other={'0123456789ABCDEF'})))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# -*- coding: UTF-8
+""" Tests of the pack behind the packed backends """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from packed import INDEX_TAIL, Pack
+
+
+class PackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def reopened(self):
+        pack = Pack(self.directory)
+        pack.update()
+        return pack
+
+    def test_append_and_reopen(self):
+        pack = Pack(self.directory)
+        pack.append([('a/one', b'1'), ('b', b'2\n\x00')])
+        pack.append([('a/one', b'replaced'), ('b', None), ('c', b'')])
+
+        for current in (pack, self.reopened()):
+            self.assertEqual(['a/one', 'c'], current.sorted_keys())
+            self.assertEqual(b'replaced', current.read('a/one'))
+            self.assertEqual(b'', current.read('c'))
+            with self.assertRaises(FileNotFoundError):
+                current.read('b')
+
+    def test_expected(self):
+        pack = Pack(self.directory)
+        pack.append([('key', b'first')], expected={'key': None})
+        with self.assertRaises(FileExistsError):
+            pack.append([('key', b'second')], expected={'key': None})
+        location = pack.locate('key')
+        pack.append([('key', b'second')], expected={'key': location})
+        self.assertEqual(b'second', self.reopened().read('key'))
+
+    def test_index(self):
+        pack = Pack(self.directory)
+        keys = ['key%04d' % number for number in range(INDEX_TAIL + 10)]
+        pack.append((key, key.encode('UTF-8')) for key in keys)
+        self.assertTrue(os.path.exists(pack.index_path))
+        pack.append([('key0000', b'new'), ('zzz', b'last')])
+
+        reopened = self.reopened()
+        self.assertEqual(sorted(keys + ['zzz']), reopened.sorted_keys())
+        self.assertEqual(b'new', reopened.read('key0000'))
+        self.assertEqual(b'key0005', reopened.read('key0005'))
+        self.assertIsNone(reopened.locate('key'))
+
+    def test_damaged_end(self):
+        pack = Pack(self.directory)
+        pack.append([('kept', b'data')])
+        with open(pack.path, 'ab') as pack_file:
+            pack_file.write(b'\x00\x00\x05')
+
+        reopened = self.reopened()
+        self.assertEqual(['kept'], reopened.sorted_keys())
+        reopened.append([('added', b'more')])
+        self.assertEqual({'kept': b'data', 'added': b'more'},
+                         {key: self.reopened().read(key)
+                          for key in ('kept', 'added')})
+
+    def test_compact(self):
+        pack = Pack(self.directory)
+        for number in range(5):
+            pack.append([('a', b'%d' % number), ('b', b'gone')])
+        pack.append([('b', None), ('c', b'c')])
+        reader = self.reopened()
+        size = os.path.getsize(pack.path)
+
+        before, after = pack.compact()
+        self.assertEqual(size, before)
+        self.assertLess(after, before)
+        self.assertEqual(after, os.path.getsize(pack.path))
+
+        # Readers of the old pack notice it was replaced
+        for current in (pack, reader, self.reopened()):
+            current.update()
+            self.assertEqual(['a', 'c'], current.sorted_keys())
+            self.assertEqual(b'4', current.read('a'))
+            self.assertEqual(b'c', current.read('c'))
+
+        pack.append([('d', b'd')])
+        self.assertEqual(['a', 'c', 'd'], self.reopened().sorted_keys())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+# -*- coding: UTF-8
+
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Nothing is measured unless enabled, the hooks then cost a function call
+enabled = False
+
+_lock = threading.Lock()
+_started = None
+# name: [seconds, calls]
+_phases = {}
+_counters = {}
+
+# Recording ###################################################################
+
+
+def enable():
+    """ Starts measuring, from now on """
+    global enabled, _started
+    with _lock:
+        _phases.clear()
+        _counters.clear()
+        _started = time.perf_counter()
+        enabled = True
+
+
+def count(name, value=1):
+    """ Adds value to the counter name """
+    if enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + value
+
+
+def add_time(name, seconds, calls=1):
+    """ Adds seconds spent in calls to the phase name """
+    if enabled:
+        with _lock:
+            phase = _phases.setdefault(name, [0.0, 0])
+            phase[0] += seconds
+            phase[1] += calls
+
+
+@contextlib.contextmanager
+def phase(name):
+    """ Adds the time spent in the with block to the phase name """
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+def measured(name):
+    """ Decorator adding the time spent in a function to the phase name
+
+    Only for plain functions, a generator would just have its creation
+    measured.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _TimedMatcher(object):
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+
+    def __getattr__(self, name):
+        return getattr(self.matcher, name)
+
+    def matches(self, key):
+        start = time.perf_counter()
+        try:
+            return self.matcher.matches(key)
+        finally:
+            add_time('match', time.perf_counter() - start)
+            count('keys_tested')
+
+    def best(self, index, limit=1):
+        with phase('match'):
+            return self.matcher.best(index, limit)
+
+
+def timed(matcher):
+    """ Returns matcher, measuring the time it spends matching if enabled
+    """
+    if not enabled or matcher is None or isinstance(matcher, _TimedMatcher):
+        return matcher
+    return _TimedMatcher(matcher)
+
+
+# Reporting ###################################################################
+
+
+def results():
+    """ Returns the phases and counters measured so far
+
+    Phases nest (the search includes the matching), their seconds are
+    summed over all calls and threads so they can add up to more than the
+    total.
+    """
+    with _lock:
+        return {
+            'total': time.perf_counter() - _started if _started else 0.0,
+            'phases': {name: {'seconds': seconds, 'calls': calls}
+                       for name, (seconds, calls) in _phases.items()},
+            'counters': dict(_counters),
+        }
+
+
+def report(stream):
+    """ Writes the results as one line of JSON to stream """
+    import json
+    stream.write(json.dumps(results(), sort_keys=True) + "\n")
+    stream.flush()
+
+
+def profile(path):
+    """ Starts cProfile, its statistics are written to path at exit
+
+    With '-' as path the most expensive calls are printed to stderr.
+    """
+    import atexit
+    import cProfile
+    import sys
+
+    profiler = cProfile.Profile()
+
+    def dump():
+        profiler.disable()
+        if '-' == path:
+            import pstats
+            stats = pstats.Stats(profiler, stream=sys.stderr)
+            stats.sort_stats('cumulative').print_stats(30)
+        else:
+            profiler.dump_stats(path)
+            log.info("Profile written to %s", path)
+
+    atexit.register(dump)
+    profiler.enable()
+    return profiler
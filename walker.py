@@ -0,0 +1,251 @@
+# -*- coding: UTF-8
+
+import logging
+import os
+
+import timings
+
+log = logging.getLogger(__name__)
+
+# Events
+ENTER = 'enter'
+LEAVE = 'leave'
+FILE = 'file'
+
+# Directories that are never descended into, besides hidden ones
+IGNORED_DIRECTORIES = frozenset(['CVS', '__pycache__'])
+
+# Helpers #####################################################################
+
+
+def is_ignored_directory(name):
+    return name.startswith('.') or name in IGNORED_DIRECTORIES
+
+
+def scan_directory(path):
+    """ Lists path, returns (sub directories, files, symbolic links)
+
+    Hidden and ignored directories are left out and both lists are sorted,
+    the links are the names of the sub directories that are symbolic
+    links. Entry types come from the directory listing itself so only
+    symbolic links are stat'ed.
+    """
+    subs = []
+    files = []
+    links = set()
+    timings.count('directories_listed')
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                # Dangling symbolic link
+                continue
+            if not is_dir:
+                files.append(entry.name)
+            elif not is_ignored_directory(entry.name):
+                subs.append(entry.name)
+                if entry.is_symlink():
+                    links.add(entry.name)
+    subs.sort()
+    files.sort()
+    return subs, files, links
+
+
+def is_loop(reals, target):
+    """ Returns True if target is one of the directories reals or one of
+    their parent directories
+    """
+    return any(real == target or real.startswith(target + os.sep)
+               for real in reals)
+
+
+def list_directory(path, root=None):
+    """ Returns sorted (sub directories, files) of path
+
+    Like scan_directory but symbolic links that loop back to path or one
+    of its parents are left out, as well as the ones looping back to a
+    directory between root and path (where path was reached through
+    other symbolic links).
+    """
+    subs, files, links = scan_directory(path)
+    if links:
+        real = os.path.realpath(path)
+        reals = [real] + _real_parents(path, root)
+        subs = [name for name in subs if name not in links or
+                not is_loop(reals, os.path.realpath(os.path.join(real,
+                                                                 name)))]
+    return subs, files
+
+
+def _real_parents(path, root=None):
+    """ Returns the resolved paths of the directories from root down to
+    the parent of path
+    """
+    reals = []
+    while root is not None and len(path) > len(root):
+        path = os.path.dirname(path)
+        reals.append(os.path.realpath(path))
+    return reals
+
+
+# Walker ######################################################################
+
+
+def walk(root, start=''):
+    """ Walks root (or the sub directory start in it) depth first
+
+    Yields (event, path, name, last) tuples where path is relative to
+    root and last is True when nothing follows the entry in its directory
+    (for LEAVE the directory left). Files in a directory come before its
+    sub directories, ENTER and LEAVE are yielded for every sub directory
+    but not for the directory where the walk starts. Symbolic links to
+    directories are followed unless they point back to a directory that
+    is being walked.
+    """
+    top = os.path.join(root, start) if start else root
+    above = _real_parents(top, root)
+
+    # The resolved path of every directory on the stack is tracked, it only
+    # takes a system call when a symbolic link is followed
+    stack = [(start, os.path.realpath(top), _listing(top), True)]
+    while stack:
+        relative, real, pending, last_dir = stack[-1]
+        item = next(pending, None)
+        if item is None:
+            stack.pop()
+            if stack:
+                yield LEAVE, relative, os.path.basename(relative), last_dir
+            continue
+
+        name, is_dir, is_link, last = item
+        path = os.path.join(relative, name)
+        if not is_dir:
+            yield FILE, path, name, last
+            continue
+
+        if is_link:
+            target = os.path.realpath(os.path.join(real, name))
+            # Every directory being walked counts, links in two siblings
+            # pointing at each other loop as well
+            if is_loop(above + [entry[1] for entry in stack], target):
+                log.warning("Not following symbolic link loop at %s",
+                            os.path.join(root, path))
+                continue
+        else:
+            target = os.path.join(real, name)
+
+        yield ENTER, path, name, last
+        stack.append((path, target, _listing(os.path.join(root, path)),
+                      last))
+
+
+def _listing(path):
+    """ Yields (name, is_dir, is_link, last), files first, for one directory
+    """
+    try:
+        subs, files, links = scan_directory(path)
+    except OSError as error:
+        log.debug("Can't list %s: %s", path, error)
+        return
+    final = len(files) + len(subs) - 1
+    for position, name in enumerate(files):
+        yield name, False, False, position == final
+    for position, name in enumerate(subs, len(files)):
+        yield name, True, name in links, position == final
+
+
+def tree_events(keys):
+    """ Yields the (event, path, name, last) tuples walk would for keys
+
+    keys are relative paths of files, in any order. The tree they make up
+    is walked like a directory: files before sub directories, both sorted.
+    """
+    tree = {}
+    for key in keys:
+        node = tree
+        parts = key.split(os.sep)
+        for part in parts[:-1]:
+            child = node.get(part)
+            if child is None:
+                child = node[part] = {}
+            node = child
+        node.setdefault(parts[-1], None)
+
+    stack = [('', _tree_listing(tree), True)]
+    while stack:
+        relative, pending, last_dir = stack[-1]
+        item = next(pending, None)
+        if item is None:
+            stack.pop()
+            if stack:
+                yield LEAVE, relative, os.path.basename(relative), last_dir
+            continue
+
+        name, children, last = item
+        path = os.path.join(relative, name)
+        if children is None:
+            yield FILE, path, name, last
+        else:
+            yield ENTER, path, name, last
+            stack.append((path, _tree_listing(children), last))
+
+
+def _tree_listing(node):
+    """ Yields (name, children or None for files, last), files first """
+    files = sorted(name for name, children in node.items()
+                   if children is None)
+    subs = sorted(name for name, children in node.items()
+                  if children is not None)
+    final = len(files) + len(subs) - 1
+    for position, name in enumerate(files):
+        yield name, None, position == final
+    for position, name in enumerate(subs, len(files)):
+        yield name, node[name], position == final
+
+
+# Directories #################################################################
+
+
+def key_directories(keys):
+    """ Returns {directory: (sub directories, file names)} for keys
+
+    keys are relative paths of files, in any order. Every directory
+    above a key is included, the root as '', and both lists are sorted.
+    """
+    directories = {'': ([], [])}
+    for key in keys:
+        parent, _, name = key.rpartition(os.sep)
+        entry = directories.get(parent)
+        if entry is None:
+            entry = directories[parent] = ([], [])
+            child = parent
+            while child:
+                up, _, sub = child.rpartition(os.sep)
+                upper = directories.get(up)
+                if upper is not None:
+                    upper[0].append(sub)
+                    break
+                upper = directories[up] = ([sub], [])
+                child = up
+        entry[1].append(name)
+
+    for subs, names in directories.values():
+        subs.sort()
+        names.sort()
+    return directories
+
+
+def key_totals(directories):
+    """ Returns {directory: number of files in and below it}
+
+    directories is {directory: (sub directories, file names)} as returned
+    by key_directories, every directory is visited once.
+    """
+    totals = {}
+    # A directory's path is always longer than its parent's
+    for relative in sorted(directories, key=len, reverse=True):
+        subs, names = directories[relative]
+        totals[relative] = len(names) + sum(
+            totals.get(os.path.join(relative, name), 0) for name in subs)
+    return totals